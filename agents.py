@@ -1,20 +1,50 @@
+import math
 import os
 import random
+import time
 from game import Board, Direction
+from kernel import random_game
+from parallel import agent_factory, imap_games, game_seed, seed_game
+from records import GameTrace, RecordWriter
+
+# most rollouts played per move and round by the time-budgeted batch flat monte carlo, which starts rounds
+# at one rollout per move and doubles them while they fit in the time left
+BATCH_CHUNK = 32
+
+# head_to_head early stopping tests a win rate (among decisive games) of 0.5 - SPRT_MARGIN against 0.5 + SPRT_MARGIN
+SPRT_MARGIN = 0.05
+
+@agent_factory
+def random_agent(seed = None):
+    ''' Plays uniformly random moves, drawn from a stream of its own if seeded, otherwise from the random module '''
+
+    rng = None if seed is None else random.Random(seed)
 
-def random_agent():
     def policy(position):
-        return random.choice(position.legal_moves())
+        return (rng or random).choice(position.legal_moves())
+
+    policy.rng = rng
 
     return policy
 
-def greedy_agent():
+@agent_factory
+def greedy_agent(evaluator = None):
+    ''' Picks the move scoring the most points this turn
+
+    With an evaluator (such as an ntuple.NTupleNetwork), moves are instead ranked by the score of the
+    position they slide to plus the evaluator's estimate of it, before any tile is placed.
+    '''
+
     def policy(position):
         best_move = None
         best_score = None
 
         for move in position.legal_moves():
-            score = position.result(move).score()
+            if evaluator is None:
+                score = position.result(move).score()
+            else:
+                succ = position.successors()[move]
+                score = succ.score() + evaluator(succ)
 
             if not best_move or score > best_score:
                 best_move = move
@@ -24,6 +54,7 @@ def greedy_agent():
 
     return policy
 
+@agent_factory
 def bottom_left_agent():
     def policy(position):
         for move in [Direction.LEFT, Direction.DOWN, Direction.RIGHT, Direction.UP]:
@@ -33,7 +64,45 @@ def bottom_left_agent():
     return policy
 
 
-def flat_mc(games):
+def random_rollout(position, move, rng = None):
+    ''' Plays move and then random moves until the game is over, returns the final score
+
+    The game is played by the in-place kernel, moves and tiles drawn from rng (a random.Random) if given.
+    '''
+
+    return random_game(position.successors()[move], rng)[0]
+
+@agent_factory
+def flat_mc(games = None, batch = False, time_ms = None, playout = None, seed = None):
+    ''' Picks the move with the best total score over random rollouts
+
+    With batch set, rollouts for each move are played together by the numpy engine in batch.py.
+    With time_ms set, rollouts are played round robin over the legal moves until time_ms milliseconds
+    have passed (or games rollouts have been played, if given), then the best average score is picked;
+    the number of rollouts achieved on each move is appended to policy.iterations.
+
+    A heuristics.Playout replaces the uniformly random rollouts to game over, its value standing in for the final score.
+
+    With seed set, rollouts draw from a stream of their own instead of the random module (numpy's for batches).
+    '''
+
+    if games is None and time_ms is None:
+        raise ValueError('flat_mc needs a number of games or a time budget')
+
+    if batch and playout is not None:
+        raise ValueError('batched rollouts are always uniformly random, they cannot use a playout')
+
+    if batch:
+        from batch import random_rollouts, spread_rollouts, generator
+
+    rng = None if seed is None else random.Random(seed)
+
+    def rollout(position, move):
+        if playout is None:
+            return random_rollout(position, move, rng)
+
+        return playout(position.result(move, rng), rng)
+
     def policy(position):
         best_move = None
         best_total_score = None
@@ -41,93 +110,305 @@ def flat_mc(games):
         for move in position.legal_moves():
             total_score = 0
 
-            for _ in range(games // len(position.legal_moves())):
-                succ = position.result(move)
-
-                while not succ.game_over():
-                    succ = succ.result(random.choice(succ.legal_moves()))
-                
-                total_score += succ.score()
+            if batch:
+                total_score = int(random_rollouts(position.successors()[move], games // len(position.legal_moves()), generator(rng)).sum())
+            else:
+                for _ in range(games // len(position.legal_moves())):
+                    total_score += rollout(position, move)
             
             if not best_move or total_score > best_total_score:
                 best_move = move
                 best_total_score = total_score
 
         return best_move
-    
+
+    def timed_policy(position):
+        deadline = time.perf_counter() + time_ms / 1000
+        moves = position.legal_moves()
+
+        total_scores = { move: 0 for move in moves }
+        counts = { move: 0 for move in moves }
+        rollouts = 0
+
+        chunk = 1
+
+        while time.perf_counter() < deadline and (games is None or rollouts < games):
+            if batch:
+                # a round takes about as long as its longest game, whatever the chunk, so the first round of one
+                # rollout per move always completes and later rounds only start if they should end in time
+                start = time.perf_counter()
+                scores = spread_rollouts([position.successors()[move] for move in moves], chunk, generator(rng))
+
+                for move, row in zip(moves, scores):
+                    total_scores[move] += int(row.sum())
+                    counts[move] += chunk
+
+                rollouts += chunk * len(moves)
+
+                now = time.perf_counter()
+                if now + (now - start) > deadline:
+                    break
+
+                if now + 2 * (now - start) <= deadline:
+                    chunk = min(BATCH_CHUNK, 2 * chunk)
+            else:
+                for move in moves:
+                    total_scores[move] += rollout(position, move)
+                    counts[move] += 1
+                    rollouts += 1
+
+        timed_policy.iterations.append(rollouts)
+
+        return max(moves, key = lambda move: total_scores[move] / counts[move] if counts[move] else 0)
+
+    policy.rng = rng
+    timed_policy.rng = rng
+
+    if time_ms is not None:
+        timed_policy.iterations = []
+        return timed_policy
+
     return policy
 
-def test_agent(policy, games = 1, size = 4, display = False):
+def play_game(policy, board, display = False, rng = None, trace = None):
+    ''' Plays one game from a fresh initial position, returns the final position
+
+    Tiles are spawned from rng (a random.Random) if given, see Position.addRandomTile. Every move, the tile
+    spawned after it and the time taken to choose it are added to trace, a records.GameTrace, if given.
+    '''
+
+    position = board.initial_position(rng)
+
+    if trace is not None:
+        trace.begin(position)
+
+    def refresh_screen():
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print(f"Score: { position.score() }")
+        position.print()
+
+    while not position.game_over():
+        if display:
+            refresh_screen()
+
+        if trace is None:
+            position = position.result(policy(position), rng)
+            continue
+
+        start = time.perf_counter()
+        move = policy(position)
+        seconds = time.perf_counter() - start
+
+        succ = position.result(move, rng)
+        trace.add(position, move, seconds, succ)
+        position = succ
+
+    if display:
+        refresh_screen()
+
+    return position
+
+def take_iterations(policy):
+    ''' The iterations a time-budgeted policy has reported since the last call (none for other policies),
+    emptied from the policy so its list never outgrows a game or a decision
+    '''
+
+    iterations = getattr(policy, "iterations", None)
+
+    if not iterations:
+        return []
+
+    taken = list(iterations)
+    iterations.clear()
+
+    return taken
+
+def _simulate_game(policies, board, display = False, record = False):
+    ''' Plays one game, returns its turns, score and high tile, the total iterations and number of moves
+    reported by a time-budgeted policy, and with record set, the game's record (see records.py)
+    '''
+
+    trace = None
+
+    if record:
+        # reseeded from the stream so the record can say which seed reproduces the game
+        seed = random.randrange(2 ** 32)
+        random.seed(seed)
+        trace = GameTrace()
+
+    position = play_game(policies[0], board, display, trace = trace)
+
+    iterations = take_iterations(policies[0])
+    searched = sum(iterations)
+    decisions = len(iterations)
+
+    gameRecord = None
+    if record:
+        gameRecord = trace.record(None, seed, position, iterations)
+
+    return position.turn(), position.score(), position.high_tile(), searched, decisions, gameRecord
+
+def _seeded_game(seed, game, objects, task, *args):
+    if seed is not None:
+        seed_game(game_seed(seed, game), objects)
+
+    return task(*args)
+
+def _recorded_results(records):
+    for record in records:
+        iterations = record.get("iterations", [])
+
+        yield record["turns"], record["score"], record["high_tile"], sum(iterations), len(iterations), record
+
+def _compete_game(policies, board):
+    scores = []
+
+    for policy in policies:
+        scores.append(play_game(policy, board).score())
+        take_iterations(policy)
+
+    return tuple(scores)
+
+def _paired_game(policies, board):
+    ''' Plays both policies on the same spawn stream, each reseeding the random module identically '''
+
+    seed = random.randrange(2 ** 32)
+    scores = []
+
+    for policy in policies:
+        random.seed(seed * 2)
+        scores.append(play_game(policy, board, rng = random.Random(seed * 2 + 1)).score())
+        take_iterations(policy)
+
+    return tuple(scores)
+
+def sprt(wins, losses, confidence):
+    ''' Sequential probability ratio test of a decisive game win rate of 0.5 + SPRT_MARGIN against 0.5 - SPRT_MARGIN,
+    with both error rates 1 - confidence. Returns 1 or 2 once the policy that wins more is established, else None.
+    '''
+
+    high = 0.5 + SPRT_MARGIN
+    low = 0.5 - SPRT_MARGIN
+    error = 1 - confidence
+
+    llr = wins * math.log(high / low) + losses * math.log((1 - high) / (1 - low))
+
+    if llr >= math.log((1 - error) / error):
+        return 1
+    if llr <= math.log(error / (1 - error)):
+        return 2
+
+    return None
+
+def close_agents(*policies):
+    ''' Releases whatever the policies hold on to between moves, such as worker pools '''
+
+    for policy in policies:
+        close = getattr(policy, "close", None)
+
+        if close is not None:
+            close()
+
+def test_agent(policy, games = 1, size = 4, display = False, backend = 'list', workers = 1, record = None, resume = False, seed = None):
     ''' Plays 2048 on a board of size "size" with a given policy for "games" number of games
+
+    With more than one worker, games are spread over a pool of processes (display is not supported)
+
+    With record set to a path, a record of every game is appended to that file as soon as the game ends.
+    With resume also set, games already recorded there count towards "games" and only the rest are played.
+
+    With seed set, every game is seeded from it (see parallel.seed_game), so the same games are played
+    whatever the number of workers.
     '''
 
-    board = Board(size)
+    board = Board(size, backend = backend)
 
     if games < 1:
         return
 
-    totalTurns = 0
-    totalScore = 0
-    highTiles = {}
+    writer = None
+    previous = []
 
-    for i in range(games):
-        position = board.initial_position()
+    if record is not None:
+        writer = RecordWriter(record, resume)
+        previous = writer.records[:games]
 
-        def refresh_screen():
-            os.system('cls' if os.name == 'nt' else 'clear')
-            print(f"Score: { position.score() }")
-            position.print()
+    remaining = games - len(previous)
 
-        while not position.game_over():
-            if display:
-                refresh_screen()
+    if workers > 1 and remaining > 0:
+        played = imap_games(_simulate_game, [policy], remaining, workers, seed, (board, False, writer is not None), len(previous))
+    else:
+        played = (_seeded_game(seed, i, [policy, board], _simulate_game, [policy], board, display, writer is not None) for i in range(len(previous), games))
 
-            position = position.result(policy(position))
+    def results():
+        yield from _recorded_results(previous)
 
-        if display:
-            refresh_screen()
+        for game, result in enumerate(played, len(previous)):
+            if writer is not None:
+                result[5]["game"] = game
+                writer.write(result[5])
+
+            yield result
 
-        totalTurns += position.turn()
-        totalScore += position.score()
-        highTile = position.high_tile()
+        if writer is not None:
+            writer.close()
+
+    totalTurns = 0
+    totalScore = 0
+    totalSearched = 0
+    totalDecisions = 0
+    highTiles = {}
+
+    for turns, score, highTile, searched, decisions, _ in results():
+        totalTurns += turns
+        totalScore += score
+        totalSearched += searched
+        totalDecisions += decisions
 
         if highTile in highTiles:
             highTiles[highTile] += 1
         else:
             highTiles[highTile] = 1
-        
+
+    close_agents(policy)
+
     print(f"Average score: { totalScore / games }")
     print(f"Average turn count: { totalTurns / games }")
+    if totalDecisions > 0:
+        print(f"Average iterations per move: { totalSearched / totalDecisions }")
     print(f"High tile distribution:")
     for tile, count in sorted(highTiles.items(), reverse=True):
         print(f"{ tile }: { count } ({count * 100 / games}%)")
 
-def head_to_head(policy1, policy2, games = 1, size = 4):
-    ''' Pits two policies against each other, reports win rate of first policy '''
+def head_to_head(policy1, policy2, games = 1, size = 4, backend = 'list', workers = 1, paired = False, confidence = None, seed = None):
+    ''' Pits two policies against each other, reports win rate of first policy
 
-    board = Board(size)
+    With paired set, each game plays both policies on the same tile spawns (common random numbers), so that
+    luck largely cancels out of their comparison. With a confidence level (such as 0.95) set, play stops as
+    soon as a sequential test establishes which policy wins more often, games becoming an upper bound.
+    Games are seeded from seed as in test_agent.
+    '''
+
+    board = Board(size, backend = backend)
 
     if games < 1:
         return
 
+    task = _paired_game if paired else _compete_game
+
+    if workers > 1:
+        results = imap_games(task, [policy1, policy2], games, workers, seed, (board,))
+    else:
+        results = (_seeded_game(seed, i, [policy1, policy2, board], task, [policy1, policy2], board) for i in range(games))
+
     win1 = 0
     win2 = 0
     draw = 0
+    played = 0
+    decision = None
 
-    for i in range(games):
-        position = board.initial_position()
-
-        while not position.game_over():
-            position = position.result(policy1(position))
-
-        score1 = position.score()
-
-        position = board.initial_position()
-
-        while not position.game_over():
-            position = position.result(policy2(position))
-
-        score2 = position.score()
+    for score1, score2 in results:
+        played += 1
 
         if score1 > score2:
             win1 += 1
@@ -136,5 +417,20 @@ def head_to_head(policy1, policy2, games = 1, size = 4):
         else:
             draw += 1
 
-        
-    print(f"Policy 1 win rate: { win1 / games }")
\ No newline at end of file
+        if confidence is not None:
+            decision = sprt(win1, win2, confidence)
+
+            if decision is not None:
+                break
+
+    # stops any pool still playing games
+    results.close()
+    close_agents(policy1, policy2)
+
+    print(f"Policy 1 win rate: { win1 / played }")
+
+    if confidence is not None:
+        if decision is None:
+            print(f"No decision at { confidence } confidence after { played } games")
+        else:
+            print(f"Policy { decision } wins more often at { confidence } confidence, decided after { played } games")
@@ -0,0 +1,129 @@
+import random
+import numpy as np
+
+# Vectorized random rollouts: a batch of N games is stored as an (N, size, size)
+# array of tile exponents (0 for empty) and every game is advanced one move per
+# step. All four slides are computed for the whole batch at once, then each game
+# picks a random legal one and spawns a random tile.
+
+def position_to_array(position):
+    tiles = np.array(position.tiles(), dtype = np.int64)
+    exponents = np.zeros(tiles.shape, dtype = np.int8)
+    exponents[tiles > 0] = np.log2(tiles[tiles > 0]).astype(np.int8)
+
+    return exponents
+
+def _compact(boards):
+    ''' Pushes the nonzero cells of each row to the left, keeping their order '''
+
+    order = np.argsort(boards == 0, axis = -1, kind = 'stable')
+    return np.take_along_axis(boards, order, axis = -1)
+
+def _compress(boards):
+    ''' Slides every row of the batch to the left, returns new boards and score gained per game '''
+
+    boards = _compact(boards)
+    scores = np.zeros(boards.shape[0], dtype = np.int64)
+
+    for k in range(boards.shape[-1] - 1):
+        merge = (boards[..., k] == boards[..., k + 1]) & (boards[..., k] != 0)
+
+        boards[..., k] += merge
+        boards[..., k + 1][merge] = 0
+        scores += np.where(merge, np.left_shift(1, boards[..., k].astype(np.int64)), 0).sum(axis = -1)
+
+    return _compact(boards), scores
+
+def slide_all(boards):
+    ''' Returns boards after each of the four slides, shape (4, N, size, size), and the scores gained, shape (4, N)
+
+    Directions are ordered as game.Direction: up, down, left, right.
+    '''
+
+    transposed = boards.transpose(0, 2, 1)
+
+    up, upScore = _compress(transposed)
+    down, downScore = _compress(transposed[..., ::-1])
+    left, leftScore = _compress(boards)
+    right, rightScore = _compress(boards[..., ::-1])
+
+    results = np.stack([up.transpose(0, 2, 1), down[..., ::-1].transpose(0, 2, 1), left, right[..., ::-1]])
+    scores = np.stack([upScore, downScore, leftScore, rightScore])
+
+    return results, scores
+
+def spawn(boards, fp, rng):
+    ''' Places a 2 (or a 4 with probability fp) on a uniformly chosen free cell of every board, in place '''
+
+    n, size, _ = boards.shape
+    flat = boards.reshape(n, size * size)
+
+    weights = rng.random((n, size * size)) * (flat == 0)
+    cells = np.argmax(weights, axis = 1)
+
+    flat[np.arange(n), cells] = np.where(rng.random(n) < fp, 2, 1)
+
+def generator(rng):
+    ''' A numpy generator seeded from rng (a random.Random), or from the random module if rng is None, so
+    seeded games repeat exactly
+    '''
+
+    return np.random.default_rng((rng or random).getrandbits(64))
+
+def random_rollouts(position, games, rng = None):
+    ''' Plays games uniformly random games from position to game over, returns their final scores
+
+    position may be a player 0 position or a slide result still waiting for its tile (player 1).
+    '''
+
+    return spread_rollouts([position], games, rng)[0]
+
+def spread_rollouts(positions, games, rng = None):
+    ''' Plays games uniformly random games from each of positions in one batch, returns their final scores
+    with shape (len(positions), games)
+
+    positions must be of the same board and all wait for the same player.
+    '''
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    position = positions[0]
+    total = len(positions) * games
+
+    boards = np.repeat(np.stack([position_to_array(p) for p in positions]), games, axis = 0)
+    scores = np.repeat(np.array([p.score() for p in positions], dtype = np.int64), games)
+    final = np.zeros(total, dtype = np.int64)
+    active = np.arange(total)
+
+    if position._player == 1:
+        spawn(boards, position._board.fp, rng)
+
+    while len(active) > 0:
+        results, gained = slide_all(boards)
+        legal = (results != boards[np.newaxis]).any(axis = (2, 3))
+
+        over = ~legal.any(axis = 0)
+        if over.any():
+            final[active[over]] = scores[over]
+
+            keep = ~over
+            active = active[keep]
+            boards = boards[keep]
+            scores = scores[keep]
+            results = results[:, keep]
+            gained = gained[:, keep]
+            legal = legal[:, keep]
+
+            if len(active) == 0:
+                break
+
+        choice = np.argmax(rng.random(legal.shape) * legal, axis = 0)
+        index = np.arange(len(active))
+
+        boards = results[choice, index]
+        scores += gained[choice, index]
+
+        spawn(boards, position._board.fp, rng)
+
+    return final.reshape(len(positions), games)
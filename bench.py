@@ -0,0 +1,169 @@
+import gc
+import json
+import platform
+import random
+import sys
+import time
+from game import Board, Direction
+from agents import flat_mc
+from mcts import mcts_agent, search
+
+# Work done by each benchmark, fixed so results are comparable between runs
+SAMPLE_GAMES = 20
+ROLLOUT_GAMES = 50
+FLAT_MC_GAMES = 100
+MCTS_ITERATIONS = 100
+DECISIONS = 10
+MEMORY_ITERATIONS = 2000
+
+def sample_positions(board, games):
+    ''' Returns the keys of every player 0 position seen in games random games '''
+
+    keys = []
+
+    for _ in range(games):
+        position = board.initial_position()
+
+        while not position.game_over():
+            keys.append(position.key())
+            position = position.result(random.choice(position.legal_moves()))
+
+    return keys
+
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+def bench_slide(board, keys):
+    # positions are rebuilt from keys so no successor is cached before timing
+    positions = [board.from_key(key) for key in keys]
+
+    start = time.perf_counter()
+    for position in positions:
+        for direction in Direction:
+            position.slide(direction)
+
+    return _rate(4 * len(positions), time.perf_counter() - start)
+
+def bench_result(board, keys):
+    positions = [board.from_key(key) for key in keys]
+    moves = [random.choice(position.legal_moves()) for position in positions]
+    positions = [board.from_key(key) for key in keys]
+
+    start = time.perf_counter()
+    for position, move in zip(positions, moves):
+        position.result(move)
+
+    return _rate(len(positions), time.perf_counter() - start)
+
+def bench_legal_moves(board, keys):
+    positions = [board.from_key(key) for key in keys]
+
+    start = time.perf_counter()
+    for position in positions:
+        position.legal_moves()
+
+    return _rate(len(positions), time.perf_counter() - start)
+
+def bench_game_over(board, keys):
+    positions = [board.from_key(key) for key in keys]
+
+    start = time.perf_counter()
+    for position in positions:
+        position.game_over()
+
+    return _rate(len(positions), time.perf_counter() - start)
+
+def bench_rollouts(board, games):
+    moves = 0
+
+    start = time.perf_counter()
+    for _ in range(games):
+        position = board.initial_position()
+
+        while not position.game_over():
+            position = position.result(random.choice(position.legal_moves()))
+            moves += 1
+
+    seconds = time.perf_counter() - start
+
+    return _rate(games, seconds), _rate(moves, seconds)
+
+def bench_decisions(policy, board, keys, decisions):
+    step = max(1, len(keys) // decisions)
+    positions = [board.from_key(key) for key in keys[::step][:decisions]]
+
+    start = time.perf_counter()
+    for position in positions:
+        policy(position)
+
+    return _rate(len(positions), time.perf_counter() - start)
+
+def bench_mcts_memory(board, keys, iterations):
+    ''' Returns the peak traced memory of one MCTS search and its node count, or None where tracemalloc does not work (PyPy) '''
+
+    if platform.python_implementation() != 'CPython':
+        return None, None
+
+    import tracemalloc
+
+    position = board.from_key(keys[len(keys) // 2])
+
+    gc.collect()
+    tracemalloc.start()
+    store, count = search(position, iterations)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak, len(store)
+
+def run_benchmarks(seed = 0, size = 4, backend = 'list'):
+    ''' Runs the benchmark suite with every random choice drawn from seed, returns the results as a dict '''
+
+    board = Board(size, backend = backend)
+    results = {}
+
+    random.seed(seed)
+    keys = sample_positions(board, SAMPLE_GAMES)
+    results["positions"] = len(keys)
+
+    random.seed(seed)
+    results["slide_per_second"] = bench_slide(board, keys)
+    random.seed(seed)
+    results["result_per_second"] = bench_result(board, keys)
+    random.seed(seed)
+    results["legal_moves_per_second"] = bench_legal_moves(board, keys)
+    random.seed(seed)
+    results["game_over_per_second"] = bench_game_over(board, keys)
+
+    random.seed(seed)
+    results["rollout_games_per_second"], results["rollout_moves_per_second"] = bench_rollouts(board, ROLLOUT_GAMES)
+
+    random.seed(seed)
+    results["flat_mc_decisions_per_second"] = bench_decisions(flat_mc(FLAT_MC_GAMES), board, keys, DECISIONS)
+    random.seed(seed)
+    results["mcts_decisions_per_second"] = bench_decisions(mcts_agent(MCTS_ITERATIONS), board, keys, DECISIONS)
+
+    random.seed(seed)
+    results["mcts_peak_bytes"], results["mcts_nodes"] = bench_mcts_memory(board, keys, MEMORY_ITERATIONS)
+
+    # the list backend's row cache, over every benchmark above
+    if board.rows is not None:
+        results["row_cache"] = board.rows.stats()
+
+    return {
+        "implementation": platform.python_implementation(),
+        "python": platform.python_version(),
+        "seed": seed,
+        "size": size,
+        "backend": backend,
+        "budgets": {
+            "flat_mc_games": FLAT_MC_GAMES,
+            "mcts_iterations": MCTS_ITERATIONS,
+            "mcts_memory_iterations": MEMORY_ITERATIONS
+        },
+        "results": results
+    }
+
+def print_benchmarks(seed = 0, size = 4, backend = 'list'):
+    json.dump(run_benchmarks(seed, size, backend), sys.stdout)
+    print()
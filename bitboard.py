@@ -0,0 +1,227 @@
+from game import Board, Direction
+from tables import load_tables
+
+# Bitboard representation of a 4x4 board: each cell is a 4-bit nibble holding
+# log2 of the tile (0 for empty), cell (i, j) lives at bit 4 * (4 * i + j), so
+# row i is the 16 bits starting at 16 * i with column 0 in the low nibble.
+
+ROW_MASK = 0xFFFF
+COL_MASK = 0x000F000F000F000F
+
+def _reverse_row(row):
+    return ((row & 0xF) << 12) | ((row >> 4 & 0xF) << 8) | ((row >> 8 & 0xF) << 4) | (row >> 12)
+
+def _spread_column(row):
+    ''' Spreads a 16 bit row into a column occupying nibble 0 of each row '''
+
+    return (row & 0xF) | ((row >> 4 & 0xF) << 16) | ((row >> 8 & 0xF) << 32) | ((row >> 12) << 48)
+
+def _compress_row(row):
+    ''' Slides a 16 bit row towards its low nibble, returns new row and score gained
+
+    Tiles of 32768 (exponent 15) are never merged, as the result would not fit in a nibble.
+    '''
+
+    line = [(row >> (4 * k)) & 0xF for k in range(4)]
+
+    newLine = []
+    score = 0
+
+    justMerged = False
+    for val in line:
+        if val != 0:
+            if not len(newLine) == 0 and not justMerged and val == newLine[-1] and val != 0xF:
+                newLine[-1] += 1
+                score += 1 << newLine[-1]
+                justMerged = True
+                continue
+
+            newLine.append(val)
+            justMerged = False
+
+    newLine += [0] * (4 - len(newLine))
+
+    return newLine[0] | (newLine[1] << 4) | (newLine[2] << 8) | (newLine[3] << 12), score
+
+def _build_tables():
+    rowLeft = [0] * 65536
+    rowRight = [0] * 65536
+    colUp = [0] * 65536
+    colDown = [0] * 65536
+    scoreLeft = [0] * 65536
+    scoreRight = [0] * 65536
+
+    for row in range(65536):
+        result, score = _compress_row(row)
+        rev = _reverse_row(row)
+
+        rowLeft[row] = result
+        scoreLeft[row] = score
+        rowRight[rev] = _reverse_row(result)
+        scoreRight[rev] = score
+
+    for row in range(65536):
+        colUp[row] = _spread_column(rowLeft[row])
+        colDown[row] = _spread_column(rowRight[row])
+
+    return rowLeft, rowRight, colUp, colDown, scoreLeft, scoreRight
+
+# built once into the table cache, then memory-mapped by every process that imports this module
+ROW_LEFT, ROW_RIGHT, COL_UP, COL_DOWN, SCORE_LEFT, SCORE_RIGHT = load_tables('bitboard', 4, None, _build_tables, ('H', 'H', 'Q', 'Q', 'I', 'I'))
+
+def _pack_column(bits, j):
+    c = (bits >> (4 * j)) & COL_MASK
+    return (c | (c >> 12) | (c >> 24) | (c >> 36)) & ROW_MASK
+
+def slide_bits(bits, move):
+    ''' Returns the board and score gained after sliding in direction move '''
+
+    if move == Direction.LEFT or move == Direction.RIGHT:
+        rows = ROW_LEFT if move == Direction.LEFT else ROW_RIGHT
+        scores = SCORE_LEFT if move == Direction.LEFT else SCORE_RIGHT
+
+        r0 = bits & ROW_MASK
+        r1 = (bits >> 16) & ROW_MASK
+        r2 = (bits >> 32) & ROW_MASK
+        r3 = bits >> 48
+
+        return (rows[r0] | (rows[r1] << 16) | (rows[r2] << 32) | (rows[r3] << 48),
+                scores[r0] + scores[r1] + scores[r2] + scores[r3])
+    else:
+        cols = COL_UP if move == Direction.UP else COL_DOWN
+        scores = SCORE_LEFT if move == Direction.UP else SCORE_RIGHT
+
+        c0 = _pack_column(bits, 0)
+        c1 = _pack_column(bits, 1)
+        c2 = _pack_column(bits, 2)
+        c3 = _pack_column(bits, 3)
+
+        return (cols[c0] | (cols[c1] << 4) | (cols[c2] << 8) | (cols[c3] << 12),
+                scores[c0] + scores[c1] + scores[c2] + scores[c3])
+
+def tiles_to_bits(tiles):
+    bits = 0
+
+    for i in range(4):
+        for j in range(4):
+            if tiles[i][j] != 0:
+                bits |= (tiles[i][j].bit_length() - 1) << (4 * (4 * i + j))
+
+    return bits
+
+def bits_to_tiles(bits):
+    tiles = []
+
+    for i in range(4):
+        row = []
+        for j in range(4):
+            e = (bits >> (4 * (4 * i + j))) & 0xF
+            row.append(1 << e if e else 0)
+        tiles.append(row)
+
+    return tiles
+
+def transpose_bits(bits):
+    a1 = bits & 0xF0F00F0FF0F00F0F
+    a2 = bits & 0x0000F0F00000F0F0
+    a3 = bits & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+def mirror_columns_bits(bits):
+    return (((bits & 0x000F000F000F000F) << 12) | ((bits & 0x00F000F000F000F0) << 4)
+            | ((bits >> 4) & 0x00F000F000F000F0) | ((bits >> 12) & 0x000F000F000F000F))
+
+def mirror_rows_bits(bits):
+    return ((bits & 0xFFFF) << 48) | ((bits & 0xFFFF0000) << 16) | ((bits >> 16) & 0xFFFF0000) | (bits >> 48)
+
+class BitboardPosition(Board.Position):
+    ''' Position for 4x4 boards packed into a single 64-bit integer, moves use precomputed row and column tables '''
+
+    __slots__ = ('_bits',)
+
+    def __init__(self, board, bits, score = 0, turn = 0):
+        if board is None:
+            raise ValueError('board cannot be None')
+
+        if board.size != 4:
+            raise ValueError('bitboard positions require a board of size 4: %d' % board.size)
+
+        self._board = board
+        self._bits = bits
+        self._score = score
+        self._turn = turn
+        self._player = 0
+        self._slides = None
+        self._hash = None
+
+    @classmethod
+    def _unpack(cls, board, packed, score, turn):
+        return cls(board, packed, score, turn)
+
+    def _pack(self):
+        return self._bits
+
+    def tiles(self):
+        return bits_to_tiles(self._bits)
+
+    def _symmetric_packs(self):
+        bits = self._bits
+        t = transpose_bits(bits)
+        c = mirror_columns_bits(bits)
+        tc = mirror_columns_bits(t)
+
+        return [bits, t, c, tc, mirror_rows_bits(bits), mirror_rows_bits(t), mirror_rows_bits(c), mirror_rows_bits(tc)]
+
+    def duplicate(self):
+        return BitboardPosition(self._board, self._bits, score = self._score, turn = self._turn)
+
+    def free_spaces(self):
+        spaces = []
+
+        bits = self._bits
+        for k in range(16):
+            if bits & 0xF == 0:
+                spaces.append((k >> 2, k & 3))
+            bits >>= 4
+
+        return spaces
+
+    def addTile(self, i, j, val):
+        return BitboardPosition(self._board, self._bits | ((val.bit_length() - 1) << (4 * (4 * i + j))), score = self._score, turn = self._turn)
+
+    def slide(self, move):
+        bits, gained = slide_bits(self._bits, move)
+
+        if bits == self._bits:
+            return None
+
+        succ = BitboardPosition(self._board, bits, score = self._score + gained, turn = self._turn)
+        succ._player = 1
+
+        return succ
+
+    def high_tile(self):
+        bits = self._bits
+        largest = 0
+
+        while bits:
+            if bits & 0xF > largest:
+                largest = bits & 0xF
+            bits >>= 4
+
+        return 1 << largest if largest else 0
+
+    def _tile_hash(self):
+        return self._bits
+
+    # overriding __eq__ would otherwise clear the inherited __hash__
+    __hash__ = Board.Position.__hash__
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self._bits == other._bits and self._turn == other._turn and self._board is other._board and self._score == other._score and self._player == other._player
@@ -1,8 +1,13 @@
 import sys
 import os
+import random
 from agents import random_agent, greedy_agent, bottom_left_agent, flat_mc, test_agent, head_to_head
-from mcts import mcts_agent
-from game import cli_play_game
+from mcts import mcts_agent, SearchStats, WIDENING_EXPONENT
+from expectimax import expectimax_agent
+from heuristics import Playout, POLICIES, TERMS, evaluator
+from ntuple import NTupleNetwork, train
+from game import Board, cli_play_game
+from records import read_records, replay
 
 def refresh_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -23,13 +28,48 @@ def print_readme():
     print("        b - bottom left (choose first legal move in following order: left, down, right, up)")
     print("        f [number of games] - flat monte carlo (arg indicates how many random rollouts performed, evenly split between legal moves)")
     print("        m [number of iterations] - MCTS (arg indicates how many tree iterations performed)")
+    print("        e [milliseconds] - expectimax (arg indicates search time per move, deepened iteratively)")
     print("    Optional additional args:")
     print("        -size [size] - Change size of game board (available to -play as well)")
+    print("        -backend [list|bitboard|packed] - Change board representation, bitboard is fastest but 4x4 only, packed is faster than list at any size (available to -play as well)")
     print("        -games [number of games] - Change number of games simulated (defaults to 1)")
     print("        -display - View games as they are played")
+    print("        -workers [number of processes] - Spread games over several processes (defaults to 1)")
+    print("        -time [milliseconds] - Stop flat monte carlo and MCTS searches after this long per move (their arg becomes an upper bound)")
+    print("        -search-workers [number of processes] - Run independent MCTS trees in parallel for each move, merging their root statistics")
+    print("        -leaf-rollouts [number of rollouts] - Play several random games from each MCTS leaf (defaults to 1)")
+    print("        -reuse - Keep the MCTS tree between moves")
+    print("        -top-up - Keep the MCTS tree between moves, counting its visits towards the next move's iterations")
+    print("        -profile [file] - Append a JSON line per MCTS move to file, with time spent in each search phase and tree counters")
+    print("        -record [file] - Append a JSON line per game to file as it finishes: seed, moves, spawns, decision times and result")
+    print("        -resume - Keep the games already in the -record file, only playing the rest")
+    print("        -seed [seed] - Seed every game, so runs repeat exactly whatever the number of workers (available to -play, -compete and -train as well)")
+    print("        -batch - Play monte carlo rollouts as vectorized batches (requires numpy)")
+    print("        -rollout-policy [random|corner] - Move choice in flat monte carlo and MCTS rollouts (defaults to random)")
+    print("        -rollout-depth [moves] - Cut rollouts off after this many moves and add a static evaluation of the position reached")
+    print("        -evaluator [combined|empty|merges|monotonicity|corner] - Static evaluation for -rollout-depth (defaults to combined)")
+    print("        -ntuple [weights file] - Value leaves with an n-tuple network trained by -train instead of rollouts (also ranks greedy moves)")
+    print("        -symmetry - Share MCTS and expectimax statistics between rotations and reflections of a position")
+    print("        -widening [exponent|none] - Progressive widening of MCTS chance nodes: at most visits^exponent tile spawns expanded (defaults to 0.5)")
     print("./Driver -compete [agent1] [agent1 args] [agent2] [agent2 args]")
     print("    Compete two computational intelligences against each other")
     print("    Optional additional args from -simulate also available (except display)")
+    print("        -paired - Play both agents on the same tile spawns in each game")
+    print("        -confidence [level] - Stop as soon as the stronger agent is established at this confidence (such as 0.95), -games becoming a maximum")
+    print("./Driver -serve [agent] [agent args]")
+    print("    Serve games against an agent to many clients at once, as JSON lines over stdin/stdout or a socket")
+    print("    Optional additional args from -simulate also available (except display, games, record and seed)")
+    print("        -socket [path] - Listen on a unix socket instead of stdin/stdout")
+    print("        -port [port] - Listen on a TCP port of localhost instead of stdin/stdout")
+    print("        -deadline [milliseconds] - Fail agent requests that get no move within this long, unless they give a deadline of their own")
+    print("./Driver -replay [file] [game number]")
+    print("    Rebuild a game recorded with -record (defaults to game 0), printing its final board, or every board with -display")
+    print("./Driver -bench")
+    print("    Benchmark the game engine and agents, printing the results as JSON")
+    print("    Optional args: -size, -backend, -seed [seed] (defaults to 0)")
+    print("./Driver -train [number of games] [weights file]")
+    print("    Train an n-tuple network by self-play, continuing from the weights file if it exists")
+    print("    Optional args: -size, -backend, -learning-rate [rate] (defaults to 0.0025)")
     print("./Driver -readme")
     print("    View this page")
     print()
@@ -38,183 +78,332 @@ def apology(message = "Input malformed, consult documentation or run ./Driver -r
     print(message, file = sys.stderr)
     exit()
 
+def parse_agent(index, name = "Agent"):
+    ''' Builds the agent named at sys.argv[index], returns it with the index of the next unread argument '''
+
+    if len(sys.argv) <= index:
+        apology()
+
+    if sys.argv[index] == 'r':
+        return random_agent(), index + 1
+    elif sys.argv[index] == 'g':
+        return greedy_agent(ntuple_network()), index + 1
+    elif sys.argv[index] == 'b':
+        return bottom_left_agent(), index + 1
+    elif sys.argv[index] == 'f':
+        try:
+            games = int(sys.argv[index + 1])
+        except:
+            apology("Missing games argument to agent.")
+        if games < 1:
+            apology("Games argument must be positive.")
+
+        return flat_mc(games, batch_rollouts(), time_budget(), playout()), index + 2
+    elif sys.argv[index] == 'm':
+        try:
+            iterations = int(sys.argv[index + 1])
+        except:
+            apology("Missing iterations argument to agent.")
+        if iterations < 1:
+            apology("Iterations argument must be positive.")
+
+        return mcts_agent(iterations, search_workers(), leaf_rollouts(), batch_rollouts(), *tree_reuse(), time_budget(), search_profile(), "-symmetry" in sys.argv, playout(), widening = widening()), index + 2
+    elif sys.argv[index] == 'e':
+        try:
+            milliseconds = int(sys.argv[index + 1])
+        except:
+            apology("Missing time argument to agent.")
+        if milliseconds < 1:
+            apology("Time argument must be positive.")
+
+        return expectimax_agent(milliseconds, symmetry = "-symmetry" in sys.argv), index + 2
+    else:
+        apology(f"{ name } not recognized.")
+
+def widening():
+    exponent = option('-widening', WIDENING_EXPONENT, "Widening must be a non-negative number or none.", convert = lambda arg: None if arg == 'none' else float(arg))
+
+    if exponent is not None and exponent < 0:
+        apology("Widening must be a non-negative number or none.")
+
+    return exponent
+
+def batch_rollouts():
+    if "-batch" not in sys.argv:
+        return False
+
+    try:
+        import numpy
+    except ImportError:
+        apology("Batched rollouts require numpy.")
+
+    return True
+
+def playout():
+    ''' Builds the heuristics.Playout asked for by -rollout-policy, -rollout-depth and -evaluator, or None for random rollouts '''
+
+    policy = option('-rollout-policy', None, "Missing rollout policy.", convert = str)
+    depth = option('-rollout-depth', None, "Rollout depth must be a non-negative integer.")
+    name = option('-evaluator', None, "Missing evaluator.", convert = str)
+    network = ntuple_network()
+
+    if policy is None and depth is None and name is None and network is None:
+        return None
+
+    if policy is not None and policy not in POLICIES:
+        apology("Rollout policy must be one of: " + ", ".join(POLICIES) + ".")
+    if depth is not None and depth < 0:
+        apology("Rollout depth must be a non-negative integer.")
+    if name is not None and name != 'combined' and name not in TERMS:
+        apology("Evaluator must be one of: combined, " + ", ".join(TERMS) + ".")
+    if "-batch" in sys.argv:
+        apology("-batch cannot be combined with -rollout-policy, -rollout-depth, -evaluator or -ntuple.")
+
+    if network is not None:
+        if name is not None:
+            apology("-evaluator cannot be combined with -ntuple.")
+
+        # the network replaces rollouts altogether unless a depth is asked for
+        return Playout(policy or 'random', 0 if depth is None else depth, network)
+
+    return Playout(policy or 'random', depth, evaluator(name) if name is not None else None)
+
+def ntuple_network():
+    path = option('-ntuple', None, "Missing n-tuple weights file.", convert = str)
+
+    if path is None:
+        return None
+
+    try:
+        network = NTupleNetwork.load(path)
+    except (OSError, ValueError) as e:
+        apology(f"Cannot load n-tuple weights: { e }")
+
+    if network.size != option('-size', 4, "Size must be a positive integer."):
+        apology("N-tuple weights were trained for another board size.")
+
+    return network
+
+def option(flag, default, message, convert = int):
+    ''' Returns the converted argument following flag, or default if flag is absent '''
+
+    try:
+        valueIndex = sys.argv.index(flag) + 1
+    except:
+        return default
+
+    try:
+        return convert(sys.argv[valueIndex])
+    except:
+        apology(message)
+
+def worker_count():
+    workers = option('-workers', 1, "Worker count must be a positive integer.")
+
+    if workers < 1:
+        apology("Worker count must be a positive integer.")
+
+    return workers
+
+def search_workers():
+    workers = option('-search-workers', 1, "Search worker count must be a positive integer.")
+
+    if workers < 1:
+        apology("Search worker count must be a positive integer.")
+    if workers > 1 and option('-workers', 1, "Worker count must be a positive integer.") > 1:
+        apology("-search-workers cannot be combined with -workers.")
+
+    return workers
+
+def search_profile():
+    path = option('-profile', None, "Missing profile output file.", convert = str)
+
+    if path is None:
+        return None
+    if option('-search-workers', 1, "Search worker count must be a positive integer.") > 1:
+        apology("-profile cannot be combined with -search-workers.")
+
+    return SearchStats(path = path)
+
+def time_budget():
+    milliseconds = option('-time', None, "Time budget must be a positive integer.")
+
+    if milliseconds is not None and milliseconds < 1:
+        apology("Time budget must be a positive integer.")
+
+    return milliseconds
+
+def tree_reuse():
+    reuse = "-reuse" in sys.argv or "-top-up" in sys.argv
+
+    if reuse and option('-search-workers', 1, "Search worker count must be a positive integer.") > 1:
+        apology("-reuse cannot be combined with -search-workers.")
+
+    return reuse, "-top-up" in sys.argv
+
+def leaf_rollouts():
+    rollouts = option('-leaf-rollouts', 1, "Leaf rollout count must be a positive integer.")
+
+    if rollouts < 1:
+        apology("Leaf rollout count must be a positive integer.")
+
+    return rollouts
+
+def board_options():
+    boardSize = option('-size', 4, "Size must be a positive integer.")
+    backend = option('-backend', 'list', "Backend must be one of: list, bitboard, packed.", convert = str)
+
+    if backend not in Board.BACKENDS:
+        apology("Backend must be one of: list, bitboard, packed.")
+    if backend == 'bitboard' and boardSize != 4:
+        apology("Bitboard backend requires size 4.")
+
+    return boardSize, backend
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print_readme()
         exit()
     
     if sys.argv[1] == '-play':
-        if len(sys.argv) == 2:
-            cli_play_game()
-            exit()
+        boardSize, backend = board_options()
 
-        if sys.argv[2] != '-size':
-            apology()
-        
-        try:
-            size = int(sys.argv[3])
-        except:
-            apology("Size must be positive integer.")
-        
-        cli_play_game(size)
+        random.seed(option('-seed', None, "Seed must be an integer."))
+        cli_play_game(boardSize, backend)
     elif sys.argv[1] == '-simulate':
-        if len(sys.argv) < 3:
-            apology()
-        
-        if sys.argv[2] == 'r':
-            agent = random_agent()
-        elif sys.argv[2] == 'g':
-            agent = greedy_agent()
-        elif sys.argv[2] == 'b':
-            agent = bottom_left_agent()
-        elif sys.argv[2] == 'f':
-            try:
-                games = int(sys.argv[3])
-            except:
-                apology("Missing games argument to agent.")
-            if games < 1:
-                apology("Games argument must be positive.")
-            
-            agent = flat_mc(games)
-        elif sys.argv[2] == 'm':
-            try:
-                iterations = int(sys.argv[3])
-            except:
-                apology("Missing iterations argument to agent.")
-            if iterations < 1:
-                apology("Iterations argument must be positive.")
-            
-            agent = mcts_agent(iterations)
-        else:
-            apology("Agent not recognized.")
+        agent, _ = parse_agent(2)
 
-        gameCount = 1
+        gameCount = option('-games', 1, "Game count must be a positive integer.")
+        boardSize, backend = board_options()
+        display = ("-display" in sys.argv)
+        workers = worker_count()
 
-        gamesIndex = None
-        try:
-            gamesIndex = sys.argv.index('-games') + 1
-        except:
-            pass
-            
-        if gamesIndex is not None:
-            try:
-                gameCount = int(sys.argv[gamesIndex])
-            except:
-                apology("Game count must be a positive integer.")
+        record = option('-record', None, "Missing record output file.", convert = str)
+        resume = "-resume" in sys.argv
 
-        boardSize = 4
+        if display and workers > 1:
+            apology("Games cannot be displayed when simulated by multiple workers.")
+        if resume and record is None:
+            apology("-resume needs a -record file.")
 
-        sizeIndex = None
-        try:
-            sizeIndex = sys.argv.index('-size') + 1
-        except:
-            pass
-            
-        if sizeIndex is not None:
-            try:
-                boardSize = int(sys.argv[sizeIndex])
-            except:
-                apology("Size must be a positive integer.")            
-        
-        display = ("-display" in sys.argv)
+        seed = option('-seed', None, "Seed must be an integer.")
 
-        test_agent(agent, gameCount, boardSize, display)
+        test_agent(agent, gameCount, boardSize, display, backend, workers, record, resume, seed)
     elif sys.argv[1] == '-compete':
-        if len(sys.argv) < 3:
-            apology()
-        
-        if sys.argv[2] == 'r':
-            agent1 = random_agent()
-            i = 4
-        elif sys.argv[2] == 'g':
-            agent1 = greedy_agent()
-            i = 4
-        elif sys.argv[2] == 'b':
-            agent1 = bottom_left_agent()
-            i = 4
-        elif sys.argv[2] == 'f':
-            try:
-                games = int(sys.argv[3])
-            except:
-                apology("Missing games argument to agent.")
-            if games < 1:
-                apology("Games argument must be positive.")
-            
-            agent1 = flat_mc(games)
-            i = 5
-        elif sys.argv[2] == 'm':
-            try:
-                iterations = int(sys.argv[3])
-            except:
-                apology("Missing iterations argument to agent.")
-            if iterations < 1:
-                apology("Iterations argument must be positive.")
-            
-            agent1 = mcts_agent(iterations)
-            i = 5
-        else:
-            apology("Agent 1 not recognized.")
-
-        if len(sys.argv) < i:
-            apology()
-        
-        if sys.argv[i - 1] == 'r':
-            agent2 = random_agent()
-        elif sys.argv[i - 1] == 'g':
-            agent2 = greedy_agent()
-        elif sys.argv[i - 1] == 'b':
-            agent2 = bottom_left_agent()
-        elif sys.argv[i - 1] == 'f':
-            try:
-                games = int(sys.argv[i])
-            except:
-                apology("Missing games argument to agent.")
-            if games < 1:
-                apology("Games argument must be positive.")
-            
-            agent2 = flat_mc(games)
-        elif sys.argv[i - 1] == 'm':
-            try:
-                iterations = int(sys.argv[i])
-            except:
-                apology("Missing iterations argument to agent.")
-            if iterations < 1:
-                apology("Iterations argument must be positive.")
-            
-            agent2 = mcts_agent(iterations)
-        else:
-            apology("Agent 2 not recognized.")
+        agent1, i = parse_agent(2, "Agent 1")
+        agent2, _ = parse_agent(i, "Agent 2")
+
+        gameCount = option('-games', 1, "Game count must be a positive integer.")
+        boardSize, backend = board_options()
+
+        workers = worker_count()
+        confidence = option('-confidence', None, "Confidence must be a number between 0.5 and 1.", convert = float)
+
+        if confidence is not None and not 0.5 < confidence < 1:
+            apology("Confidence must be a number between 0.5 and 1.")
+
+        seed = option('-seed', None, "Seed must be an integer.")
 
-        gameCount = 1
+        head_to_head(agent1, agent2, gameCount, boardSize, backend, workers, "-paired" in sys.argv, confidence, seed)
+    elif sys.argv[1] == '-bench':
+        from bench import print_benchmarks
 
-        gamesIndex = None
+        seed = option('-seed', 0, "Seed must be an integer.")
+        boardSize, backend = board_options()
+
+        print_benchmarks(seed, boardSize, backend)
+    elif sys.argv[1] == '-train':
         try:
-            gamesIndex = sys.argv.index('-games') + 1
+            gameCount = int(sys.argv[2])
+            path = sys.argv[3]
         except:
-            pass
-            
-        if gamesIndex is not None:
+            apology("Missing games or weights file argument to -train.")
+        if gameCount < 1:
+            apology("Games argument must be positive.")
+
+        boardSize, backend = board_options()
+        learningRate = option('-learning-rate', 0.0025, "Learning rate must be a number.", convert = float)
+
+        network = None
+        if os.path.exists(path):
             try:
-                gameCount = int(sys.argv[gamesIndex])
-            except:
-                apology("Game count must be a positive integer.")
+                network = NTupleNetwork.load(path, writable = True)
+            except ValueError as e:
+                apology(f"Cannot load n-tuple weights: { e }")
+            if network.size != boardSize:
+                apology("N-tuple weights were trained for another board size.")
+
+        random.seed(option('-seed', None, "Seed must be an integer."))
+        recent = []
+
+        def report(game, score):
+            recent.append(score)
 
-        boardSize = 4
+            if len(recent) == 100 or game == gameCount - 1:
+                print(f"Games { game + 1 - len(recent) + 1 }-{ game + 1 }: average score { sum(recent) / len(recent) }")
+                recent.clear()
 
-        sizeIndex = None
+        network = train(Board(boardSize, backend = backend), gameCount, network, learningRate, report)
+        network.save(path)
+    elif sys.argv[1] == '-serve':
+        from server import serve
+
+        agent, _ = parse_agent(2)
+        boardSize, backend = board_options()
+
+        path = option('-socket', None, "Missing socket path.", convert = str)
+        port = option('-port', None, "Port must be an integer between 1 and 65535.")
+        deadline = option('-deadline', None, "Deadline must be a positive integer.")
+
+        if port is not None and not 0 < port < 65536:
+            apology("Port must be an integer between 1 and 65535.")
+        if path is not None and port is not None:
+            apology("-socket cannot be combined with -port.")
+        if deadline is not None and deadline < 1:
+            apology("Deadline must be a positive integer.")
+
+        serve(agent, boardSize, backend, worker_count(), deadline, path, port)
+    elif sys.argv[1] == '-replay':
         try:
-            sizeIndex = sys.argv.index('-size') + 1
-        except:
-            pass
-            
-        if sizeIndex is not None:
+            path = sys.argv[2]
+            records, _ = read_records(path)
+        except (IndexError, OSError):
+            apology("Missing or unreadable record file.")
+
+        game = 0
+        if len(sys.argv) > 3 and not sys.argv[3].startswith('-'):
             try:
-                boardSize = int(sys.argv[sizeIndex])
+                game = int(sys.argv[3])
             except:
-                apology("Size must be a positive integer.")
+                apology("Game number must be an integer.")
+
+        matches = [record for record in records if record["game"] == game]
+        if not matches:
+            apology(f"No record of game { game } in { path }.")
+
+        record = matches[0]
+        backend = option('-backend', 'list', "Backend must be one of: list, bitboard, packed.", convert = str)
+        if backend not in Board.BACKENDS:
+            apology("Backend must be one of: list, bitboard, packed.")
+        if backend == 'bitboard' and record["size"] != 4:
+            apology("Bitboard backend requires size 4.")
+
+        board = Board(record["size"], record["fp"], backend)
+        display = "-display" in sys.argv
+
+        try:
+            for position in replay(board, record):
+                if display:
+                    print(f"Turn { position.turn() }, score { position.score() }")
+                    position.print()
+        except ValueError as e:
+            apology(f"Replay failed: { e }")
+
+        if not display:
+            position.print()
 
-        head_to_head(agent1, agent2, gameCount, boardSize)
+        print(f"Game { game } (seed { record['seed'] }): score { position.score() }, { position.turn() } turns, high tile { position.high_tile() }")
     elif sys.argv[1] == '-readme':
         print_readme()
     else:
-        apology()
\ No newline at end of file
+        apology()
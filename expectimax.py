@@ -0,0 +1,160 @@
+import time
+from game import transpose, reflect
+from parallel import agent_factory
+
+_snakes = {}
+
+def snake_weights(size):
+    ''' Weight matrices for the 8 orientations of a snake path from a corner, the k-th cell from the end weighing 4^k '''
+
+    if size not in _snakes:
+        weights = [[0] * size for _ in range(size)]
+
+        k = size * size - 1
+        for i in range(size):
+            for j in (range(size) if i % 2 == 0 else reversed(range(size))):
+                weights[i][j] = 4 ** k
+                k -= 1
+
+        orientations = []
+        for _ in range(4):
+            weights = reflect(transpose(weights))
+            orientations.append(weights)
+            orientations.append(reflect(weights))
+
+        _snakes[size] = orientations
+
+    return _snakes[size]
+
+def evaluate(position):
+    ''' Static value of a position: how well its tiles follow a snake of decreasing values from some corner '''
+
+    tiles = position.tiles()
+    size = len(tiles)
+
+    return max(sum(tiles[i][j] * weights[i][j] for i in range(size) for j in range(size)) for weights in snake_weights(size))
+
+# the clock is read every TICK_MASK + 1 nodes, a few microseconds of search each
+TICK_MASK = 15
+
+class SearchTimeout(Exception):
+    pass
+
+class Expectimax:
+    ''' Depth-limited expectimax over the mcts_legal_moves / mcts_result game tree
+
+    Player moves (slides) are max nodes and tile placements are chance nodes weighted by the board's
+    spawn distribution. Positions with no legal move are worth 0, and branches whose probability of being
+    reached falls below cutoff are evaluated statically instead of searched. Chance node values are cached
+    in a transposition table keyed by Position.hash, which is cleared whenever it grows past table_size
+    entries. With symmetry set the table is keyed by Position.canonical() instead, which is exact since
+    evaluate ignores score and orientation.
+    '''
+
+    def __init__(self, cutoff = 0.0001, table_size = 500000, symmetry = False):
+        self.cutoff = cutoff
+        self.table_size = table_size
+        self.symmetry = symmetry
+        self.table = {}
+        self.deadline = None
+        self.nodes = 0
+
+    def _tick(self):
+        self.nodes += 1
+
+        if self.deadline is not None and self.nodes & TICK_MASK == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    def max_value(self, position, depth, probability):
+        self._tick()
+
+        moves = position.mcts_legal_moves()
+
+        # a dead board is full, so the snake would rate it at least as well as any live one
+        if not moves:
+            return 0
+
+        if depth == 0 or probability < self.cutoff:
+            return evaluate(position)
+
+        best = None
+
+        for move in moves:
+            value = self.chance_value(position.mcts_result(move), depth, probability)
+
+            if best is None or value > best:
+                best = value
+
+        return best
+
+    def chance_value(self, position, depth, probability):
+        self._tick()
+
+        key = position.canonical()[0] if self.symmetry else position.hash
+        cached = self.table.get(key)
+        if cached is not None and cached[0] >= depth:
+            return cached[1]
+
+        moves = position.mcts_legal_moves()
+        cells = len(moves) // 2
+        fp = position._board.fp
+
+        total = 0
+        for move in moves:
+            p = (fp if move[2] == 4 else 1 - fp) / cells
+            total += p * self.max_value(position.mcts_result(move), depth - 1, probability * p)
+
+        if len(self.table) >= self.table_size:
+            self.table.clear()
+
+        self.table[key] = (depth, total)
+
+        return total
+
+    def best_move(self, position, depth):
+        bestMove = None
+        best = None
+
+        for move in position.legal_moves():
+            value = self.chance_value(position.mcts_result(move), depth, 1)
+
+            if best is None or value > best:
+                bestMove = move
+                best = value
+
+        return bestMove
+
+    def search(self, position, time_ms = None, max_depth = 20):
+        ''' Iteratively deepens until max_depth or until time_ms runs out, returns the move from the deepest
+        completed search and that depth. Depth 1 always completes, whatever the time budget.
+        '''
+
+        deadline = None if time_ms is None else time.perf_counter() + time_ms / 1000
+
+        self.deadline = None
+        bestMove = self.best_move(position, 1)
+        depth = 1
+
+        self.deadline = deadline
+
+        try:
+            while depth < max_depth:
+                bestMove = self.best_move(position, depth + 1)
+                depth += 1
+        except SearchTimeout:
+            pass
+
+        return bestMove, depth
+
+@agent_factory
+def expectimax_agent(time_ms = 100, max_depth = 20, cutoff = 0.0001, table_size = 500000, symmetry = False):
+    ''' Expectimax with iterative deepening under a per-move budget of time_ms milliseconds '''
+
+    searcher = Expectimax(cutoff, table_size, symmetry)
+
+    def policy(position):
+        move, depth = searcher.search(position, time_ms, max_depth)
+
+        return move
+
+    return policy
@@ -1,4 +1,5 @@
 import random
+from collections import OrderedDict
 from enum import Enum
 import os
 import sys
@@ -15,28 +16,237 @@ def transpose(m):
 def reflect(m):
     return [row[::-1] for row in m]
 
+# The 8 symmetries of a square board are numbered 0-7: bit 0 transposes, then bit 1 mirrors columns
+# (j becomes size - 1 - j), then bit 2 mirrors rows (i becomes size - 1 - i).
+
+def symmetric_cell(i, j, size, symmetry):
+    if symmetry & 1:
+        i, j = j, i
+    if symmetry & 2:
+        j = size - 1 - j
+    if symmetry & 4:
+        i = size - 1 - i
+
+    return i, j
+
+_TRANSPOSED = { Direction.LEFT: Direction.UP, Direction.UP: Direction.LEFT, Direction.RIGHT: Direction.DOWN, Direction.DOWN: Direction.RIGHT }
+_MIRRORED_COLUMNS = { Direction.LEFT: Direction.RIGHT, Direction.RIGHT: Direction.LEFT, Direction.UP: Direction.UP, Direction.DOWN: Direction.DOWN }
+_MIRRORED_ROWS = { Direction.UP: Direction.DOWN, Direction.DOWN: Direction.UP, Direction.LEFT: Direction.LEFT, Direction.RIGHT: Direction.RIGHT }
+
+def symmetric_move(move, size, symmetry):
+    ''' Maps a slide direction or an (i, j, val) tile placement through a symmetry of the board '''
+
+    if isinstance(move, Direction):
+        if symmetry & 1:
+            move = _TRANSPOSED[move]
+        if symmetry & 2:
+            move = _MIRRORED_COLUMNS[move]
+        if symmetry & 4:
+            move = _MIRRORED_ROWS[move]
+
+        return move
+
+    i, j, val = move
+
+    return symmetric_cell(i, j, size, symmetry) + (val,)
+
+def inverse_symmetry(symmetry):
+    for inverse in range(8):
+        if all(symmetric_cell(*symmetric_cell(i, j, 3, symmetry), 3, inverse) == (i, j) for i in range(3) for j in range(3)):
+            return inverse
+
+_symmetric_orders = {}
+
+def symmetric_orders(size):
+    ''' For each symmetry, the row-major index of the cell that every row-major cell is mapped to '''
+
+    if size not in _symmetric_orders:
+        _symmetric_orders[size] = [[(lambda c: c[0] * size + c[1])(symmetric_cell(k // size, k % size, size, symmetry)) for k in range(size * size)] for symmetry in range(8)]
+
+    return _symmetric_orders[size]
+
+_zobrist_tables = {}
+
+def zobrist_table(size):
+    ''' Random 64-bit keys for each cell and tile exponent of a size by size board, 0 for an empty cell '''
+
+    if size not in _zobrist_tables:
+        # a private generator, so building the table does not disturb the game's random stream
+        rng = random.Random(2048)
+        _zobrist_tables[size] = [[0] + [rng.getrandbits(64) for _ in range(31)] for _ in range(size * size)]
+
+    return _zobrist_tables[size]
+
+def compress_row(row):
+    ''' Slides a row of tiles towards its start, returns the new row as a tuple and the score gained '''
+
+    newRow = []
+    score = 0
+
+    # the last tile read, still free to merge with the next one
+    pending = 0
+    for val in row:
+        if val:
+            if val == pending:
+                newRow.append(2 * val)
+                score += 2 * val
+                pending = 0
+            else:
+                if pending:
+                    newRow.append(pending)
+                pending = val
+
+    if pending:
+        newRow.append(pending)
+
+    return tuple(newRow + [0] * (len(row) - len(newRow))), score
+
+# rows kept by a board's row cache, far more than the distinct rows most games on up to 5x5 ever slide
+ROW_CACHE_SIZE = 1 << 16
+
+# larger boards repeat rows too rarely for the cache to pay for its lookups, so they compress directly
+ROW_CACHE_MAX_BOARD = 5
+
+class RowCache:
+    ''' Least recently used memo of compress_row, keyed by the row as a tuple
+
+    Every list position of a board slides its rows through the board's cache. lookups, hits, misses and
+    evictions count since the cache was made.
+    '''
+
+    def __init__(self, capacity = ROW_CACHE_SIZE):
+        if capacity < 1:
+            raise ValueError('Row cache capacity must be positive: %d' % capacity)
+
+        self.capacity = capacity
+        self.rows = OrderedDict()
+        self.lookups = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def compress(self, lines):
+        ''' Returns compress_row(line) for each of lines, counted once per call rather than per line '''
+
+        rows = self.rows
+        results = []
+
+        for line in lines:
+            entry = rows.get(line)
+
+            if entry is None:
+                entry = rows[line] = compress_row(line)
+                self.misses += 1
+
+                if len(rows) > self.capacity:
+                    rows.popitem(last = False)
+                    self.evictions += 1
+            else:
+                rows.move_to_end(line)
+
+            results.append(entry)
+
+        self.lookups += len(results)
+
+        return results
+
+    @property
+    def hits(self):
+        return self.lookups - self.misses
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def stats(self):
+        return { "size": len(self.rows), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                 "evictions": self.evictions, "hit_rate": self.hit_rate() }
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __reduce__(self):
+        # copies sent to worker processes start empty rather than carrying every cached row along
+        return (RowCache, (self.capacity,))
+
 class Board:
-    def __init__(self, s = 4, fp = 0.1):
+    BACKENDS = ('list', 'bitboard', 'packed')
+
+    def __init__(self, s = 4, fp = 0.1, backend = 'list', rng = None, cell_bits = None, row_cache = None):
         ''' Creates a 2048 board of size s by s
+
+        backend selects the position representation: 'list' (any size), 'bitboard' (4x4 only) or 'packed'
+        (any size, cell_bits bits per cell, 5 by default, so tiles up to 2^(2^cell_bits - 1)). Tiles are
+        spawned from rng (a random.Random) if given, otherwise from the random module. List positions slide
+        through a RowCache of row_cache rows kept in rows, None if row_cache is 0. By default boards up to
+        ROW_CACHE_MAX_BOARD get one of ROW_CACHE_SIZE rows.
         '''
-        
+
         if s < 1:
             raise ValueError('Board dimension must be positive: %d' % s)
-        
+
+        if backend not in Board.BACKENDS:
+            raise ValueError('Unknown board backend: %s' % backend)
+
+        if backend == 'bitboard' and s != 4:
+            raise ValueError('bitboard backend requires a board of size 4: %d' % s)
+
+        if cell_bits is not None and backend != 'packed':
+            raise ValueError('only the packed backend has a configurable number of bits per cell')
+
+        if backend == 'packed' and cell_bits is not None and not 4 <= cell_bits <= 8:
+            raise ValueError('packed backend needs 4 to 8 bits per cell: %d' % cell_bits)
+
+        # bits per cell of Position.key(), which the packed backend also uses to store its tiles
+        if backend == 'packed':
+            self.cell_bits = 5 if cell_bits is None else cell_bits
+        else:
+            self.cell_bits = 4 if backend == 'bitboard' else 5
+
         self.size = s
         self.fp = fp
+        self.backend = backend
+        self.rng = rng
+        if row_cache is None:
+            row_cache = ROW_CACHE_SIZE if s <= ROW_CACHE_MAX_BOARD else 0
 
-    def initial_position(self):
-        tiles = [[0] * self.size for _ in range(self.size)]
+        self.rows = RowCache(row_cache) if backend == 'list' and row_cache else None
 
-        p = Board.Position(self, tiles)
+    def position_class(self):
+        if self.backend == 'bitboard':
+            from bitboard import BitboardPosition
+            return BitboardPosition
 
-        p = p.addRandomTile()
-        p = p.addRandomTile()
+        if self.backend == 'packed':
+            from packed import PackedPosition
+            return PackedPosition
+
+        return Board.Position
+
+    def empty_position(self):
+        return self.position_class()._unpack(self, 0, 0, 0)
+
+    def from_key(self, key):
+        ''' Rebuilds the position that Position.key() returned key for '''
+
+        cls = self.position_class()
+        tileBits = self.cell_bits * self.size * self.size
+        rest = key >> tileBits
+
+        p = cls._unpack(self, key & ((1 << tileBits) - 1), rest >> 33, (rest >> 1) & 0xFFFFFFFF)
+        p._player = rest & 1
+
+        return p
+
+    def initial_position(self, rng = None):
+        p = self.empty_position()
+
+        p = p.addRandomTile(rng)
+        p = p.addRandomTile(rng)
 
         return p
 
     class Position:
+        __slots__ = ('_board', '_tiles', '_score', '_turn', '_player', '_slides', '_hash', '_zobrist')
+
         def __init__(self, board, tiles, score = 0, turn = 0):
             if board is None:
                 raise ValueError('board cannot be None')
@@ -49,8 +259,73 @@ class Board:
             self._score = score
             self._turn = turn
             self._player = 0
+            self._slides = None
+
+            # computed on first use, so positions that are never hashed (rollouts) never pay for it
+            self._hash = None
+            self._zobrist = None
+
+        @classmethod
+        def _unpack(cls, board, packed, score, turn):
+            tiles = []
+
+            for i in range(board.size):
+                row = []
+                for j in range(board.size):
+                    e = packed & 0x1F
+                    row.append(1 << e if e else 0)
+                    packed >>= 5
+                tiles.append(row)
+
+            return cls(board, tiles, score, turn)
+
+        def _pack(self):
+            packed = 0
+
+            for row in reversed(self._tiles):
+                for val in reversed(row):
+                    packed = (packed << 5) | (val.bit_length() - 1 if val else 0)
+
+            return packed
+
+        def key(self):
+            ''' Compact integer identifying the position: its tiles, score, turn (below 2^32) and player to move '''
+
+            return (((self._score << 32 | self._turn) << 1 | self._player) << (self._board.cell_bits * self._board.size * self._board.size)) | self._pack()
+
+        def _symmetric_packs(self):
+            ''' The tiles packed as in key(), under each of the 8 symmetries '''
+
+            cells = [val.bit_length() - 1 if val else 0 for row in self.tiles() for val in row]
+            bits = self._board.cell_bits
+            packs = []
+
+            for order in symmetric_orders(self._board.size):
+                packed = 0
+                for k, e in enumerate(cells):
+                    packed |= e << (bits * order[k])
+                packs.append(packed)
+
+            return packs
+
+        def canonical(self):
+            ''' Returns a key identifying the position's tiles and player to move up to rotation and reflection,
+            ignoring score and turn, and the symmetry that maps this position onto the canonical orientation
+            '''
+
+            packs = self._symmetric_packs()
+            symmetry = min(range(8), key = packs.__getitem__)
+
+            return (packs[symmetry] << 1) | self._player, symmetry
+
+        def __getstate__(self):
+            return { name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ()) if name != '_slides' and hasattr(self, name) }
+
+        def __setstate__(self, state):
+            for name, value in state.items():
+                setattr(self, name, value)
 
-            self._compute_hash()
+            self._slides = None
 
         def duplicate(self):
             return Board.Position(self._board, [row[:] for row in self._tiles], score = self._score, turn = self._turn)
@@ -72,10 +347,24 @@ class Board:
 
             return succ
 
-        def addRandomTile(self):
-            i, j = random.choice(self.free_spaces())
+        def addRandomTile(self, rng = None):
+            ''' Places a 2, or a 4 with probability fp, on a random free cell
 
-            if random.random() < self._board.fp:
+            Draws from the board's rng, or from rng (a random.Random) if given, taking exactly two numbers
+            from it per tile: games given equally seeded streams then get the same spawns turn by turn, even
+            once their boards differ.
+            '''
+
+            if rng is not None:
+                spaces = self.free_spaces()
+                i, j = spaces[int(rng.random() * len(spaces))]
+
+                return self.addTile(i, j, 4 if rng.random() < self._board.fp else 2)
+
+            source = self._board.rng or random
+            i, j = source.choice(self.free_spaces())
+
+            if source.random() < self._board.fp:
                 return self.addTile(i, j, 4)
             else:
                 return self.addTile(i, j, 2)
@@ -132,55 +421,73 @@ class Board:
 
             return succ
 
-        def _compress(self, row):
-            newRow = []
-            
-            justMerged = False
-            for val in row:
-                if val != 0:
-                    if not len(newRow) == 0 and not justMerged and val == newRow[-1]:
-                        newRow[-1] *= 2
-                        self._score += newRow[-1]
-                        justMerged = True
-                        continue
-                    
-                    newRow.append(val)
-                    justMerged = False
-
-            return newRow + ([0] * (self._board.size - len(newRow)))
-
         def slide(self, move):
-            succ = self.duplicate()
-
-            transposed = (move == Direction.DOWN or move == Direction.UP)
-            flipped = (move == Direction.RIGHT or move == Direction.DOWN)
+            ''' Slides every row or column (through the board's row cache if it has one), reading lines in the
+            order they slide and writing the results straight into the new tiles, so no transposed or reflected
+            copy of the board is made
+            '''
+
+            tiles = self._tiles
+
+            if move == Direction.LEFT:
+                lines = [tuple(row) for row in tiles]
+            elif move == Direction.RIGHT:
+                lines = [tuple(reversed(row)) for row in tiles]
+            elif move == Direction.UP:
+                lines = list(zip(*tiles))
+            else:
+                lines = list(zip(*reversed(tiles)))
 
-            if transposed:
-                succ._tiles = transpose(succ._tiles)
-            if flipped:
-                succ._tiles = reflect(succ._tiles)
-            
-            succ._tiles = [ succ._compress(row) for row in succ._tiles ]
+            if self._board.rows is not None:
+                results = self._board.rows.compress(lines)
+            else:
+                results = [compress_row(line) for line in lines]
 
-            if flipped:
-                succ._tiles = reflect(succ._tiles)
-            if transposed:
-                succ._tiles = transpose(succ._tiles)
+            gained = 0
+            moved = False
+            for line, (newLine, score) in zip(lines, results):
+                if newLine != line:
+                    moved = True
+                    gained += score
 
-            if succ._tiles == self._tiles:
+            if not moved:
                 return None
 
+            if move == Direction.LEFT:
+                newTiles = [list(newLine) for newLine, _ in results]
+            elif move == Direction.RIGHT:
+                newTiles = [list(reversed(newLine)) for newLine, _ in results]
+            elif move == Direction.UP:
+                newTiles = [list(row) for row in zip(*[newLine for newLine, _ in results])]
+            else:
+                newTiles = [list(row) for row in zip(*[newLine for newLine, _ in results])][::-1]
+
+            succ = Board.Position(self._board, newTiles, score = self._score + gained, turn = self._turn)
             succ._player = 1
 
             return succ
 
-        def result(self, move):
-            succ = self.slide(move)
+        def successors(self):
+            ''' Maps each legal slide to its resulting position, computed once and cached on the position '''
+
+            if self._slides is None:
+                self._slides = {}
+
+                for direction in Direction:
+                    succ = self.slide(direction)
+
+                    if succ:
+                        self._slides[direction] = succ
+
+            return self._slides
+
+        def result(self, move, rng = None):
+            succ = self.successors().get(move)
 
             if not succ:
                 return None
 
-            succ = succ.addRandomTile()
+            succ = succ.addRandomTile(rng)
             succ._turn += 1
 
             return succ
@@ -195,19 +502,37 @@ class Board:
             return max(max(row) for row in self._tiles)
 
         def game_over(self):
-            return self._player == 0 and len(self.free_spaces()) == 0 and not self.slide(Direction.LEFT) and not self.slide(Direction.DOWN)
+            return self._player == 0 and len(self.successors()) == 0
 
         def legal_moves(self):
-            moves = []
+            return list(self.successors())
+
+        def _tile_hash(self):
+            ''' Zobrist hash of the tiles, computed on first use '''
+
+            if self._zobrist is None:
+                zobrist = 0
 
-            for direction in Direction:
-                if self.slide(direction):
-                    moves.append(direction)
+                for k, keys in enumerate(zobrist_table(self._board.size)):
+                    val = self._tiles[k // self._board.size][k % self._board.size]
+                    if val:
+                        zobrist ^= keys[val.bit_length() - 1]
 
-            return moves
+                self._zobrist = zobrist
 
-        def _compute_hash(self):
-            self.hash = hash(tuple(tuple(row + [self._score, self._turn]) for row in self._tiles)) * 2 + self._player * 1
+            return self._zobrist
+
+        @property
+        def hash(self):
+            ''' Hash of the tiles, score, turn and player to move, computed on first use
+
+            Positions are not modified once hashed.
+            '''
+
+            if self._hash is None:
+                self._hash = hash((self._tile_hash(), self._score, self._turn)) * 2 + self._player
+
+            return self._hash
 
         def __hash__(self):
             return self.hash
@@ -215,8 +540,13 @@ class Board:
         def __eq__(self, other):
             return isinstance(other, self.__class__) and self._tiles == other._tiles and self._turn == other._turn and self._board is other._board and self._score == other._score and self._player == other._player
 
+        def tiles(self):
+            ''' Returns the board as a list of rows of tile values, which must not be modified '''
+
+            return self._tiles
+
         def print(self):
-            for row in self._tiles:
+            for row in self.tiles():
                 print(row)
 
         def mcts_legal_moves(self):
@@ -235,28 +565,34 @@ class Board:
             ''' Version of function which splits sliding and tile placement into two turns for mcts '''
 
             if self._player == 0:
-                return self.slide(move)
+                return self.successors().get(move)
             else:
-                return self.addTile(*move)
+                # count the turn as result() does, so a searched position equals the one actually played
+                succ = self.addTile(*move)
+                succ._turn += 1
+
+                return succ
 
         def largest_tile_on_corner(self):
             ''' Testing some heuristics '''
 
             largest = self.high_tile()
+            tiles = self.tiles()
 
-            return largest in (self._tiles[0][0], self._tiles[-1][0], self._tiles[0][-1], self._tiles[-1][-1])
+            return largest in (tiles[0][0], tiles[-1][0], tiles[0][-1], tiles[-1][-1])
 
         def largest_tile_on_edge(self):
             ''' Testing some heuristics '''
             
             largest = self.high_tile()
 
-            t_tiles = transpose(self._tiles)
+            tiles = self.tiles()
+            t_tiles = transpose(tiles)
 
-            return largest in self._tiles[0] or largest in self._tiles[-1] or largest in t_tiles[0] or largest in t_tiles[-1]
+            return largest in tiles[0] or largest in tiles[-1] or largest in t_tiles[0] or largest in t_tiles[-1]
 
-def cli_play_game(size = 4):
-    board = Board(size)
+def cli_play_game(size = 4, backend = 'list'):
+    board = Board(size, backend = backend)
     pos = board.initial_position()
 
     message = "Select move (U/D/L/R/exit): "
@@ -0,0 +1,146 @@
+import random
+from game import Direction, transpose
+
+# Static evaluation terms: each scores how promising a position's tiles look, higher being better.
+
+def empty_cells(position):
+    return sum(row.count(0) for row in position.tiles())
+
+def merges(position):
+    ''' Number of pairs of equal adjacent tiles, which a single slide could merge '''
+
+    tiles = position.tiles()
+    size = len(tiles)
+    count = 0
+
+    for i in range(size):
+        for j in range(size):
+            val = tiles[i][j]
+
+            if val:
+                if j + 1 < size and tiles[i][j + 1] == val:
+                    count += 1
+                if i + 1 < size and tiles[i + 1][j] == val:
+                    count += 1
+
+    return count
+
+def monotonicity(position):
+    ''' Minus how far rows and columns are from monotonic: for each line, the smaller of the total rise and fall
+    in value between its consecutive tiles, skipping empty cells so that merging is never penalized
+    '''
+
+    tiles = position.tiles()
+    penalty = 0
+
+    for line in tiles + transpose(tiles):
+        line = [val for val in line if val]
+        rise = 0
+        fall = 0
+
+        for a, b in zip(line, line[1:]):
+            if a < b:
+                rise += b - a
+            else:
+                fall += a - b
+
+        penalty += min(rise, fall)
+
+    return -penalty
+
+def corner(position):
+    return position.high_tile() if position.largest_tile_on_corner() else 0
+
+TERMS = { 'empty': empty_cells, 'merges': merges, 'monotonicity': monotonicity, 'corner': corner }
+
+# points of score per unit of each term
+DEFAULT_WEIGHTS = { 'empty': 128, 'merges': 64, 'monotonicity': 1, 'corner': 1 }
+
+class Evaluator:
+    ''' Weighted sum of evaluation terms, in points of score '''
+
+    def __init__(self, weights = None):
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+
+        for name in self.weights:
+            if name not in TERMS:
+                raise ValueError('Unknown evaluation term: %s' % name)
+
+    def __call__(self, position):
+        return sum(weight * TERMS[name](position) for name, weight in self.weights.items())
+
+def evaluator(name):
+    ''' A single term with its default weight, or all of them for 'combined' '''
+
+    if name == 'combined':
+        return Evaluator()
+
+    if name not in TERMS:
+        raise ValueError('Unknown evaluation term: %s' % name)
+
+    return Evaluator({ name: DEFAULT_WEIGHTS[name] })
+
+# Rollout policies: pick the move a rollout plays from a position, drawing from rng (a random.Random)
+# or, if it is None, from the random module.
+
+def random_policy(position, rng = None):
+    return (rng or random).choice(position.legal_moves())
+
+def corner_policy(position, rng = None):
+    ''' First legal move in the order left, down, right, up, as bottom_left_agent plays '''
+
+    moves = position.successors()
+
+    for move in (Direction.LEFT, Direction.DOWN, Direction.RIGHT, Direction.UP):
+        if move in moves:
+            return move
+
+POLICIES = { 'random': random_policy, 'corner': corner_policy }
+
+class Playout:
+    ''' Rollout played by policy from a position for at most depth moves (to game over if depth is None)
+
+    Its value is the score reached, plus evaluator's estimate of the final position when the rollout was cut
+    off before game over. A position still waiting for its tile gets a random one first, unless depth is 0,
+    in which case the position is evaluated as it is.
+    '''
+
+    def __init__(self, policy = 'random', depth = None, evaluator = None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown rollout policy: %s' % policy)
+
+        if depth is not None and evaluator is None:
+            evaluator = Evaluator()
+
+        self.policy = policy
+        self.depth = depth
+        self.evaluator = evaluator
+
+    def play(self, position, rng = None):
+        ''' Returns the position the rollout stops at, drawing moves and tiles from rng if given '''
+
+        if self.depth == 0:
+            return position
+
+        policy = POLICIES[self.policy]
+
+        if position._player == 1:
+            position = position.addRandomTile(rng)
+            position._turn += 1
+
+        moves = 0
+
+        while (self.depth is None or moves < self.depth) and not position.game_over():
+            position = position.result(policy(position, rng), rng)
+            moves += 1
+
+        return position
+
+    def value(self, position):
+        if self.evaluator is None or position.game_over():
+            return position.score()
+
+        return position.score() + self.evaluator(position)
+
+    def __call__(self, position, rng = None):
+        return self.value(self.play(position, rng))
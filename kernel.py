@@ -0,0 +1,120 @@
+import random
+from itertools import permutations
+
+# Allocation-free random rollouts: a game is played to its end on a single flat list of tile exponents (0 for
+# empty), cell (i, j) at index size * i + j. Slides rewrite the list in place line by line, the number of
+# free cells is kept up to date as tiles merge and spawn, and no Position is built along the way.
+
+# every order of the four slides: the first slide of a uniformly drawn order that moves the board is a
+# uniformly random legal move
+ORDERS = tuple(permutations(range(4)))
+
+_lines = {}
+
+def slide_lines(size):
+    ''' For up, down, left and right in turn, the cell indexes of every line in the order the line slides '''
+
+    if size not in _lines:
+        rows = [tuple(i * size + j for j in range(size)) for i in range(size)]
+        columns = [tuple(i * size + j for i in range(size)) for j in range(size)]
+
+        _lines[size] = (tuple(columns), tuple(column[::-1] for column in columns), tuple(rows), tuple(row[::-1] for row in rows))
+
+    return _lines[size]
+
+def slide_cells(cells, lines, cap = -1):
+    ''' Slides cells in place along lines (one entry of slide_lines), never merging exponent cap
+
+    Returns the score gained and the number of merges, or None, leaving cells untouched, if nothing moves.
+    '''
+
+    gained = 0
+    merges = 0
+    moved = False
+
+    for line in lines:
+        # write is the next free slot of the line, last the tile before it while it may still merge
+        write = 0
+        last = 0
+
+        for k in line:
+            e = cells[k]
+
+            if e == 0:
+                continue
+
+            if e == last and e != cap:
+                cells[line[write - 1]] = e + 1
+                cells[k] = 0
+                gained += 1 << (e + 1)
+                merges += 1
+                last = 0
+                moved = True
+            else:
+                target = line[write]
+
+                if target != k:
+                    cells[target] = e
+                    cells[k] = 0
+                    moved = True
+
+                write += 1
+                last = e
+
+    return (gained, merges) if moved else None
+
+def random_game(position, rng = None):
+    ''' Plays uniformly random moves from position until the game is over, returns the final score, high tile
+    and turn count
+
+    position may be a player 0 position or a slide result still waiting for its tile (player 1). Tiles are
+    placed on a uniformly random free cell, a 4 with the board's probability fp. Moves and tiles are drawn
+    from rng (a random.Random) if given, otherwise from the random module.
+    '''
+
+    board = position._board
+    size = board.size
+    fp = board.fp
+    rand = (rng or random).random
+    lines = slide_lines(size)
+
+    # the bitboard and packed backends never merge the largest exponent their cells can hold
+    cap = -1 if board.backend == 'list' else (1 << board.cell_bits) - 1
+
+    cells = [val.bit_length() - 1 if val else 0 for row in position.tiles() for val in row]
+    free = cells.count(0)
+    score = position.score()
+    turns = position.turn()
+
+    spawn = position._player == 1
+
+    while True:
+        if spawn:
+            nth = int(rand() * free)
+
+            for k, e in enumerate(cells):
+                if e == 0:
+                    if nth == 0:
+                        break
+                    nth -= 1
+
+            cells[k] = 2 if rand() < fp else 1
+            free -= 1
+            turns += 1
+
+        for move in ORDERS[int(rand() * 24)]:
+            slid = slide_cells(cells, lines[move], cap)
+
+            if slid is not None:
+                score += slid[0]
+                free += slid[1]
+                break
+        else:
+            # no slide moves the board
+            break
+
+        spawn = True
+
+    high = max(cells)
+
+    return score, 1 << high if high else 0, turns
@@ -1,74 +1,326 @@
 import pdb
+import json
 import random
 import math
+import time
+from array import array
+import multiprocessing
+from parallel import agent_factory
+from game import symmetric_move, inverse_symmetry
+from kernel import random_game
 
-### helper functions
+### node store
+
+class NodeStore:
+    ''' MCTS statistics kept in parallel arrays indexed by integer node id
+
+    Each position in the tree gets a node id through index, which is keyed by Position.key() so that no
+    Position objects are kept alive by the store; keys[node] holds the key back, from which the board can
+    rebuild the position. Once a node is expanded, its edges occupy the contiguous range firstEdge[node]
+    to firstEdge[node] + edgeCount[node] of the edge arrays, and edgeChild holds the node each edge leads to.
+    Chance nodes (a tile to place) get an edge for every possible spawn on expansion, but each edge's child
+    is only added once that spawn is drawn: until then edgeChild is -1. expanded[node] counts the edges of
+    node that have a child.
+
+    With symmetry set, index is keyed by Position.canonical() instead, so every rotation or reflection of a
+    position, whatever its score and turn, shares one node. keys[node] then holds the key of the first
+    position seen for the node, and the node's edge moves are in that position's orientation.
+    '''
+
+    def __init__(self, board, symmetry = False):
+        self.board = board
+        self.symmetry = symmetry
+        self.index = {}
+        self.moves = {}
 
-def ucbBestMove(position, table):
-    if position._player == 1:
-        minMove = None
-        minVal = None
+        self.keys = []
+        self.player = bytearray()
+        self.totalReward = array('d')
+        self.totalVisits = array('q')
+        self.firstEdge = array('q')
+        self.edgeCount = array('l')
+        self.expanded = array('l')
 
-        for move in position.mcts_legal_moves():
-            child = position.mcts_result(move)
-            if not minMove or minVal > table[child]["totalVisits"]:
-                minMove = move
-                minVal = table[child]["totalVisits"]
+        self.edgeMoves = []
+        self.edgeChild = array('q')
+        self.edgeReward = array('d')
+        self.edgeVisits = array('q')
 
-        return minMove
+    def node(self, position):
+        ''' Returns the id of position, adding an unexpanded node for it if it is not in the store '''
 
-    bestMove = -1
+        key = position.key()
+
+        if self.symmetry:
+            return self.nodeForKey(position.canonical()[0], position._player, key)
+
+        return self.nodeForKey(key, position._player, key)
+
+    def nodeForKey(self, key, player, positionKey):
+        node = self.index.get(key)
+
+        if node is None:
+            node = len(self.totalVisits)
+            self.index[key] = node
+
+            self.keys.append(positionKey)
+            self.player.append(player)
+            self.totalReward.append(0)
+            self.totalVisits.append(0)
+            self.firstEdge.append(-1)
+            self.edgeCount.append(0)
+            self.expanded.append(0)
+
+        return node
+
+    def position(self, node):
+        return self.board.from_key(self.keys[node])
+
+    def orient(self, node, position, moves):
+        ''' Maps moves out of node onto position, which must be a rotation or reflection of node's position '''
+
+        if not self.symmetry:
+            return moves
+
+        size = self.board.size
+        toCanonical = self.position(node).canonical()[1]
+        fromCanonical = inverse_symmetry(position.canonical()[1])
+
+        return [symmetric_move(symmetric_move(move, size, toCanonical), size, fromCanonical) for move in moves]
+
+    def addEdge(self, move, child):
+        # chance moves are fresh (i, j, val) tuples on every call, share one copy of each
+        self.edgeMoves.append(self.moves.setdefault(move, move))
+        self.edgeChild.append(child)
+        self.edgeReward.append(0)
+        self.edgeVisits.append(0)
+
+    def edges(self, node):
+        return range(self.firstEdge[node], self.firstEdge[node] + self.edgeCount[node])
+
+    def reroot(self, position):
+        ''' Returns a new store holding only the nodes reachable from position, which becomes node 0,
+        or None if position is not in this store
+        '''
+
+        old = self.index.get(position.canonical()[0] if self.symmetry else position.key())
+
+        if old is None:
+            return None
+
+        indexKeys = self.keys
+        if self.symmetry:
+            indexKeys = [None] * len(self)
+            for key, node in self.index.items():
+                indexKeys[node] = key
+
+        store = NodeStore(self.board, self.symmetry)
+        remap = { old: store.nodeForKey(indexKeys[old], self.player[old], self.keys[old]) }
+        order = [old]
+
+        for node in order:
+            new = remap[node]
+
+            store.totalReward[new] = self.totalReward[node]
+            store.totalVisits[new] = self.totalVisits[node]
+            store.expanded[new] = self.expanded[node]
+
+            if self.firstEdge[node] < 0:
+                continue
+
+            store.firstEdge[new] = len(store.edgeMoves)
+            store.edgeCount[new] = self.edgeCount[node]
+
+            for edge in self.edges(node):
+                child = self.edgeChild[edge]
+
+                if child >= 0 and child not in remap:
+                    remap[child] = store.nodeForKey(indexKeys[child], self.player[child], self.keys[child])
+                    order.append(child)
+
+                store.addEdge(self.edgeMoves[edge], remap[child] if child >= 0 else -1)
+                store.edgeReward[-1] = self.edgeReward[edge]
+                store.edgeVisits[-1] = self.edgeVisits[edge]
+
+        return store
+
+    def __len__(self):
+        return len(self.totalVisits)
+
+### profiling
+
+class SearchStats:
+    ''' Opt-in profile of MCTS searches
+
+    search() adds per-phase wall time (selection, expansion, rollout, backpropagation) and counters for
+    the current move to this object. finish() then closes the move: its summary is appended to moves,
+    passed to callback and, if path is set, appended to that file as a line of JSON.
+    '''
+
+    def __init__(self, callback = None, path = None):
+        self.callback = callback
+        self.path = path
+        self.moves = []
+        self.reset()
+
+    def reset(self):
+        self.selection = 0.0
+        self.expansion = 0.0
+        self.rollout = 0.0
+        self.backpropagation = 0.0
+        self.iterations = 0
+        self.nodesCreated = 0
+        self.rollouts = 0
+        self.rolloutMoves = 0
+        self.timedRollouts = 0
+        self.maxRolloutMoves = 0
+
+    def recordRollout(self, moves):
+        self.rolloutMoves += moves
+        self.timedRollouts += 1
+        self.maxRolloutMoves = max(self.maxRolloutMoves, moves)
+
+    def finish(self, store):
+        keys = store.keys
+
+        summary = {
+            "move": len(self.moves),
+            "iterations": self.iterations,
+            "selection_seconds": self.selection,
+            "expansion_seconds": self.expansion,
+            "rollout_seconds": self.rollout,
+            "backpropagation_seconds": self.backpropagation,
+            "nodes_created": self.nodesCreated,
+            "table_size": len(store),
+            "edges": len(store.edgeMoves),
+            "root_visits": store.totalVisits[0],
+            "rollouts": self.rollouts,
+            "mean_rollout_moves": self.rolloutMoves / self.timedRollouts if self.timedRollouts else None,
+            "max_rollout_moves": self.maxRolloutMoves if self.timedRollouts else None,
+            "hash_collisions": len(keys) - len({ hash(key) for key in keys })
+        }
+
+        self.moves.append(summary)
+
+        if self.callback is not None:
+            self.callback(summary)
+
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(summary) + "\n")
+
+        self.reset()
+
+        return summary
+
+### helper functions
+
+# progressive widening: a chance node visited n times has at most WIDENING_COEFFICIENT * n^widening children
+WIDENING_COEFFICIENT = 1.0
+WIDENING_EXPONENT = 0.5
+
+def ucbBestMove(node, store):
+    ''' Returns the edge to follow from node, a node choosing a slide '''
+
+    bestEdge = -1
     ucb = None
 
-    for move in position.mcts_legal_moves():
-        childPosition = position.mcts_result(move)
+    for edge in store.edges(node):
+        child = store.edgeChild[edge]
 
-        if table[childPosition]["totalVisits"] == 0 or table[position]["moveDict"][move]["edgeVisits"] == 0:
-            return move
+        if store.totalVisits[child] == 0 or store.edgeVisits[edge] == 0:
+            return edge
 
-        exploit = table[childPosition]["totalReward"] / table[childPosition]["totalVisits"]
-        explore = math.sqrt(0.5 * math.log(table[position]["totalVisits"]) / table[position]["moveDict"][move]["edgeVisits"])
+        exploit = store.totalReward[child] / store.totalVisits[child]
+        explore = math.sqrt(0.5 * math.log(store.totalVisits[node]) / store.edgeVisits[edge])
 
         total = (exploit + explore)
 
         if not ucb or ucb < total:
             ucb = total
-            bestMove = move
+            bestEdge = edge
 
-    return bestMove
+    return bestEdge
+
+def chanceEdge(node, store, widening = WIDENING_EXPONENT, rng = None):
+    ''' Returns the edge to follow from node, a chance node, drawing a spawn by its true probability
+
+    A spawn drawn for the first time gets its child added, unless node already has as many children as
+    progressive widening allows for its visits, in which case the spawn is drawn again from those children
+    (by probability as well). widening None lets every drawn spawn in.
+    '''
+
+    source = rng or random
+    fp = store.board.fp
 
-def hasChildren(position, table):
-    return ("moveDict" in table[position])
+    # edges come in (i, j, 2), (i, j, 4) pairs, one pair per free cell, as mcts_legal_moves lists them
+    first = store.firstEdge[node]
+    edge = first + 2 * int(source.random() * (store.edgeCount[node] // 2)) + (1 if source.random() < fp else 0)
 
-def addChildren(position, table):
-    table[position]["moveDict"] = {}
+    if store.edgeChild[edge] >= 0:
+        return edge
 
-    for move in position.mcts_legal_moves():
-        table[position]["moveDict"][move] = { "edgeReward": 0, "edgeVisits": 0 }
+    if widening is not None and store.expanded[node] >= WIDENING_COEFFICIENT * store.totalVisits[node] ** widening:
+        children = [edge for edge in store.edges(node) if store.edgeChild[edge] >= 0]
+        weights = [fp if (edge - first) & 1 else 1 - fp for edge in children]
 
-        childPosition = position.mcts_result(move)
+        draw = source.random() * sum(weights)
+        for edge, weight in zip(children, weights):
+            draw -= weight
+            if draw < 0:
+                return edge
 
-        if childPosition not in table:
-            table[childPosition] = {
-                "totalReward": 0,
-                "totalVisits": 0
-            }
+        return children[-1]
 
-def randomChild(position):
-    return position.mcts_result(random.choice(position.mcts_legal_moves()))
+    store.edgeChild[edge] = store.node(store.position(node).mcts_result(store.edgeMoves[edge]))
+    store.expanded[node] += 1
 
-def recommendation(position, table):
+    return edge
+
+def hasChildren(node, store):
+    return store.firstEdge[node] >= 0
+
+def addChildren(position, node, store):
+    moves = position.mcts_legal_moves()
+
+    store.firstEdge[node] = len(store.edgeMoves)
+    store.edgeCount[node] = len(moves)
+
+    # the children of chance nodes are added by chanceEdge as their spawns are drawn
+    if position._player == 1:
+        for move in moves:
+            store.addEdge(move, -1)
+        return
+
+    for move in moves:
+        store.addEdge(move, store.node(position.mcts_result(move)))
+    store.expanded[node] = len(moves)
+
+def rootEdges(node, store, position):
+    ''' Returns (move, edgeVisits, edgeReward) for each edge of node, with moves as played from position,
+    or None if node has not been expanded
+    '''
+
+    if not hasChildren(node, store):
+        return None
+
+    edges = store.edges(node)
+    moves = store.orient(node, position, [store.edgeMoves[edge] for edge in edges])
+
+    return [(move, store.edgeVisits[edge], store.edgeReward[edge]) for move, edge in zip(moves, edges)]
+
+def recommendation(position, edges, rng = None):
     bestMove = -1
     bestAvgVal = None
 
-    if "moveDict" not in table[position]:
-        return random.choice(position.mcts_legal_moves())
+    if edges is None:
+        return (rng or random).choice(position.mcts_legal_moves())
 
-    for move, val in table[position]["moveDict"].items():
-        if val["edgeVisits"] == 0:
+    for move, edgeVisits, edgeReward in edges:
+        if edgeVisits == 0:
             return move
 
-        avgVal = val["edgeReward"] / val["edgeVisits"]
+        avgVal = edgeReward / edgeVisits
 
         if not bestAvgVal or bestAvgVal < avgVal:
             bestMove = move
@@ -76,62 +328,270 @@ def recommendation(position, table):
     
     return bestMove
 
+def rollout(leaf, leaf_rollouts, batch, stats = None, playout = None, rng = None):
+    ''' Plays leaf_rollouts random games from leaf, or leaf_rollouts of playout (a heuristics.Playout) if given,
+    returns their summed value. Random choices are drawn from rng (a random.Random) if given.
+    '''
+
+    if stats is not None:
+        stats.rollouts += leaf_rollouts
+
+    if batch:
+        from batch import random_rollouts, generator
+
+        return int(random_rollouts(leaf, leaf_rollouts, generator(rng)).sum()) / 3932156
+
+    total = 0
+
+    if playout is not None:
+        for _ in range(leaf_rollouts):
+            curr = playout.play(leaf, rng)
+            total += playout.value(curr) / 3932156
+
+            if stats is not None:
+                stats.recordRollout(curr.turn() - leaf.turn())
+
+        return total
+
+    for _ in range(leaf_rollouts):
+        score, high, turns = random_game(leaf, rng)
+
+        # Experimented with different value functions - score scled
+        # value = math.log(high, 2) / 15
+        # value = high / 131072
+        # value = score
+        total += score / 3932156
+
+        if stats is not None:
+            stats.recordRollout(turns - leaf.turn())
+
+    return total
+
+def search(position, iterations, leaf_rollouts = 1, batch = False, store = None, deadline = None, stats = None, symmetry = False, playout = None, rng = None, widening = WIDENING_EXPONENT):
+    ''' Runs MCTS from position, returns the node store, in which position is node 0, and the number of
+    iterations run
+
+    Stops after iterations iterations or once time.perf_counter() passes deadline, whichever comes first
+    (either may be None). Every iteration plays leaf_rollouts games from the selected leaf (as one numpy
+    batch if batch is set). A store from an earlier search, rerooted at position, can be passed to continue
+    from its statistics. Phase times and counters are added to stats, a SearchStats, if given. symmetry is
+    passed on to a new store, and leaves are valued by playout instead of random games if it is given.
+    Rollouts and chance node spawns draw from rng (a random.Random) if given, otherwise from the random
+    module. widening is the progressive widening exponent of chance nodes (see chanceEdge).
+    '''
+
+    if store is None:
+        store = NodeStore(position._board, symmetry)
+
+    root = store.node(position)
+    count = 0
+
+    if stats is not None:
+        initialNodes = len(store)
+
+    while iterations is None or count < iterations:
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+
+        count += 1
+
+        if stats is not None:
+            start = time.perf_counter()
+
+        # pass through tree by child pointers, searching for leaf, adding children if node encountered without children explicitly populated
+        path = []
+        node = root
+
+        while True:
+            if store.totalVisits[node] == 0:
+                break
+            
+            if not hasChildren(node, store):
+                if stats is not None:
+                    expansionStart = time.perf_counter()
+                    addChildren(store.position(node), node, store)
+                    stats.expansion += time.perf_counter() - expansionStart
+                    start += time.perf_counter() - expansionStart
+                else:
+                    addChildren(store.position(node), node, store)
+
+            # expanded nodes without edges are game over
+            if store.edgeCount[node] == 0:
+                break
+
+            if store.player[node] == 1:
+                edge = chanceEdge(node, store, widening, rng)
+            else:
+                edge = ucbBestMove(node, store)
+
+            path.append((node, edge))
+
+            node = store.edgeChild[edge]
+
+        leaf = position if node == root else store.position(node)
+
+        if stats is not None:
+            now = time.perf_counter()
+            stats.selection += now - start
+            start = now
+
+        # simulate random games
+        value = rollout(leaf, leaf_rollouts, batch, stats, playout, rng)
+
+        if stats is not None:
+            now = time.perf_counter()
+            stats.rollout += now - start
+            start = now
+
+        # propagate new statistics from top
+        for pathNode, edge in path:
+            store.totalVisits[pathNode] += leaf_rollouts
+            store.totalReward[pathNode] += value
+            store.edgeVisits[edge] += leaf_rollouts
+            store.edgeReward[edge] += value
+
+        store.totalVisits[node] += leaf_rollouts
+        store.totalReward[node] += value
+
+        if stats is not None:
+            stats.backpropagation += time.perf_counter() - start
+
+    if stats is not None:
+        stats.iterations += count
+        stats.nodesCreated += len(store) - initialNodes
+
+    return store, count
+
+def _root_search(job):
+    ''' Worker process entry point for root parallel search, returns the root edge statistics '''
+
+    position, iterations, leaf_rollouts, batch, time_ms, symmetry, playout, widening, seed = job
+
+    random.seed(seed)
+
+    deadline = None
+    if time_ms is not None:
+        deadline = time.perf_counter() + time_ms / 1000
+
+    store, count = search(position, iterations, leaf_rollouts, batch, deadline = deadline, symmetry = symmetry, playout = playout, widening = widening)
+
+    return rootEdges(0, store, position), count
+
 ### mcts_strategy
 
-def mcts_agent(iterations):
+@agent_factory
+def mcts_agent(iterations = None, workers = 1, leaf_rollouts = 1, batch = False, reuse = False, top_up = False, time_ms = None, stats = None, symmetry = False, playout = None, seed = None, widening = WIDENING_EXPONENT):
+    ''' With more than one worker, each move runs independent trees in a pool of processes (root parallelism)
+    and recommends from their summed root statistics. leaf_rollouts > 1 plays several games from each selected
+    leaf (leaf parallelism), vectorized when batch is set.
+
+    With reuse set, the tree is kept between moves and rerooted at the position actually reached, and with
+    top_up set, iterations already spent on that subtree count towards this move's iterations.
+
+    With time_ms set, each move searches for at most time_ms milliseconds (and at most iterations iterations,
+    if given) and the number of iterations achieved is appended to the policy's iterations list.
+
+    Passing a SearchStats as stats profiles every search and finishes one summary per move.
+
+    With symmetry set, rotations and reflections of a position share statistics whatever their score and turn.
+
+    A heuristics.Playout replaces the random games played from each leaf, for instance with truncated
+    rollouts finished by a static evaluation.
+
+    With seed set, searches draw from a stream of their own instead of the random module, and so do the
+    seeds handed to root parallel workers. The pool of root parallel workers lives until policy.close() is
+    called.
+
+    Chance nodes follow tile spawns drawn by their true probabilities, adding children only as spawns are
+    drawn and, unless widening is None, no more than the progressive widening exponent widening allows.
+    '''
+
+    if iterations is None and time_ms is None:
+        raise ValueError('mcts_agent needs a number of iterations or a time budget')
+
+    if batch and playout is not None:
+        raise ValueError('batched rollouts are always uniformly random, they cannot use a playout')
+
+    if reuse and workers > 1:
+        raise ValueError('tree reuse is not supported with root parallel search')
+
+    if stats is not None and workers > 1:
+        raise ValueError('profiling is not supported with root parallel search')
+
+    pool = None
+    store = None
+    rng = None if seed is None else random.Random(seed)
 
     def mcts_recommend_move(position):
+        nonlocal pool, store
 
-        table = {
-            position: {
-                "totalReward": 0,
-                "totalVisits": 0
-            }
-        }
+        if workers == 1:
+            deadline = None
+            if time_ms is not None:
+                deadline = time.perf_counter() + time_ms / 1000
+
+            if reuse and store is not None:
+                store = store.reroot(position)
+
+            count = iterations
+            if store is not None and top_up and iterations is not None:
+                count = max(0, iterations - store.totalVisits[0] // leaf_rollouts)
+
+            searched, count = search(position, count, leaf_rollouts, batch, store, deadline, stats, symmetry, playout, rng, widening)
+
+            if stats is not None:
+                stats.finish(searched)
+            if reuse:
+                store = searched
+            if time_ms is not None:
+                mcts_recommend_move.iterations.append(count)
+
+            return recommendation(position, rootEdges(0, searched, position), rng)
+
+        if pool is None:
+            pool = multiprocessing.Pool(workers)
+
+        jobs = []
+        for i in range(workers):
+            share = None
+            if iterations is not None:
+                share = iterations // workers + (1 if i < iterations % workers else 0)
+
+            jobs.append((position, share, leaf_rollouts, batch, time_ms, symmetry, playout, widening, (rng or random).randrange(2 ** 32)))
+
+        merged = {}
+        total = 0
 
-        for i in range(iterations):
+        for edges, count in pool.map(_root_search, jobs):
+            total += count
 
-            # pass through tree, searching for leaf, adding children if node encountered without children explicitly populated
-            path = []
-            leaf = position
+            for move, edgeVisits, edgeReward in edges or []:
+                visits, reward = merged.get(move, (0, 0))
+                merged[move] = (visits + edgeVisits, reward + edgeReward)
 
-            while True:
-                if leaf.game_over() or table[leaf]["totalVisits"] == 0:
-                    break
-                
-                if not hasChildren(leaf, table):
-                    addChildren(leaf, table)
+        if time_ms is not None:
+            mcts_recommend_move.iterations.append(total)
 
-                move = ucbBestMove(leaf, table)
-                path.append(move)
+        if not merged:
+            return recommendation(position, None, rng)
 
-                leaf = leaf.mcts_result(move)
+        return recommendation(position, [(move, visits, reward) for move, (visits, reward) in merged.items()], rng)
 
-            # simulate random game
-            curr = leaf
-            while not curr.game_over():
-                curr = randomChild(curr)
+    mcts_recommend_move.rng = rng
 
-            # Experimented with different value functions - score scled
-            # value = math.log(curr.high_tile(), 2) / 15
-            # value = curr.high_tile() / 131072
-            # value = curr.score()
-            value = curr.score() / 3932156
+    def close():
+        ''' Shuts down the root parallel pool, if any (a later move starts a new one) '''
 
-            # propagate new statistics from top
-            curr = position
+        nonlocal pool
 
-            for move in path:
-                table[curr]["totalVisits"] += 1
-                table[curr]["totalReward"] += value
-                table[curr]["moveDict"][move]["edgeVisits"] += 1
-                table[curr]["moveDict"][move]["edgeReward"] += value
-                
-                curr = curr.mcts_result(move)
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
 
-            table[curr]["totalVisits"] += 1
-            table[curr]["totalReward"] += value
+    mcts_recommend_move.close = close
 
-        return recommendation(position, table)
+    if time_ms is not None:
+        mcts_recommend_move.iterations = []
 
-    return mcts_recommend_move
\ No newline at end of file
+    return mcts_recommend_move
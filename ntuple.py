@@ -0,0 +1,229 @@
+import mmap
+import struct
+import sys
+from array import array
+from game import symmetric_cell
+
+# An n-tuple network values an afterstate (a position right after a slide, before its tile is placed) as
+# the sum of one learned weight per tuple of cells, looked up by the tile exponents in those cells. Each
+# tuple is also read under the 8 symmetries of the board, sharing its weights. Values estimate the score
+# still to be gained from the afterstate, so they add directly to Position.score().
+
+MAGIC = b'2048NTUP'
+VERSION = 1
+
+# bits per cell in a tuple's index, exponents above 15 (tiles above 32768) are clipped
+INDEX_BITS = 4
+
+def default_tuples(size):
+    ''' Outer and inner lines of up to 4 cells, and the corner, edge and centre 2x2 squares that fit '''
+
+    tuples = []
+
+    for i in range(min(2, size)):
+        tuples.append(tuple(i * size + j for j in range(min(4, size))))
+
+    for i, j in ((0, 0), (0, 1), (1, 1)):
+        if i + 1 < size and j + 1 < size:
+            tuples.append((i * size + j, i * size + j + 1, (i + 1) * size + j, (i + 1) * size + j + 1))
+
+    return tuples
+
+class NTupleNetwork:
+    ''' Afterstate value function of a size by size board
+
+    weights[t] holds 16^len(tuples[t]) float32 weights, either as arrays that can be trained or, for a
+    network opened with load(), as read-only views of a memory-mapped weights file.
+    '''
+
+    def __init__(self, size, tuples = None, weights = None):
+        self.size = size
+        self.tuples = [tuple(cells) for cells in (default_tuples(size) if tuples is None else tuples)]
+        self.weights = weights if weights is not None else [array('f', bytes(4 << (INDEX_BITS * len(cells)))) for cells in self.tuples]
+        self.path = None
+
+        # every (weights, cells) pair read by an evaluation: each tuple under each symmetry
+        self.features = []
+        for t, cells in enumerate(self.tuples):
+            for symmetry in range(8):
+                self.features.append((self.weights[t], [(lambda c: c[0] * size + c[1])(symmetric_cell(k // size, k % size, size, symmetry)) for k in cells]))
+
+    def _exponents(self, position):
+        packed = position._pack()
+        bits = position._board.cell_bits
+        mask = (1 << bits) - 1
+        exponents = []
+
+        for _ in range(self.size * self.size):
+            exponents.append(min(packed & mask, 15))
+            packed >>= bits
+
+        return exponents
+
+    def _indexes(self, exponents):
+        indexes = []
+
+        for weights, cells in self.features:
+            index = 0
+            for cell in cells:
+                index = (index << INDEX_BITS) | exponents[cell]
+            indexes.append(index)
+
+        return indexes
+
+    def value(self, position):
+        ''' Value of an afterstate '''
+
+        exponents = self._exponents(position)
+        total = 0.0
+
+        for weights, cells in self.features:
+            index = 0
+            for cell in cells:
+                index = (index << INDEX_BITS) | exponents[cell]
+            total += weights[index]
+
+        return total
+
+    def update(self, position, delta):
+        ''' Adds delta to every weight read when valuing the afterstate position '''
+
+        for (weights, cells), index in zip(self.features, self._indexes(self._exponents(position))):
+            weights[index] += delta
+
+    def __call__(self, position):
+        ''' Estimated score still to come from position, usable as a heuristics.Playout evaluator
+
+        Afterstates are valued directly, positions waiting for a slide by their best slide.
+        '''
+
+        if position._player == 1:
+            return self.value(position)
+
+        best = 0.0
+        for succ in position.successors().values():
+            best = max(best, succ.score() - position.score() + self.value(succ))
+
+        return best
+
+    def best_move(self, position):
+        ''' The slide with the highest score gained plus afterstate value, None if there is none '''
+
+        bestMove = None
+        best = None
+
+        for move, succ in position.successors().items():
+            value = succ.score() - position.score() + self.value(succ)
+
+            if best is None or value > best:
+                bestMove = move
+                best = value
+
+        return bestMove
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<III', VERSION, self.size, len(self.tuples)))
+
+            for cells in self.tuples:
+                f.write(struct.pack('<I%dI' % len(cells), len(cells), *cells))
+
+            for weights in self.weights:
+                weights = array('f', weights)
+                if sys.byteorder != 'little':
+                    weights.byteswap()
+                f.write(weights.tobytes())
+
+    @classmethod
+    def load(cls, path, writable = False):
+        ''' Opens a network saved by save()
+
+        Weights are read straight from a read-only memory map of the file, shared by every process that opens
+        it, unless writable is set (to keep training), in which case they are copied into arrays.
+        '''
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not an n-tuple weights file: %s' % path)
+
+        offset = len(MAGIC)
+        version, size, count = struct.unpack_from('<III', data, offset)
+        offset += 12
+
+        if version != VERSION:
+            raise ValueError('unsupported n-tuple weights version %d: %s' % (version, path))
+
+        tuples = []
+        for _ in range(count):
+            length, = struct.unpack_from('<I', data, offset)
+            tuples.append(struct.unpack_from('<%dI' % length, data, offset + 4))
+            offset += 4 * (length + 1)
+
+        weights = []
+        for cells in tuples:
+            end = offset + (4 << (INDEX_BITS * len(cells)))
+
+            if writable or sys.byteorder != 'little':
+                table = array('f', data[offset:end])
+                if sys.byteorder != 'little':
+                    table.byteswap()
+                weights.append(table)
+            else:
+                weights.append(memoryview(data)[offset:end].cast('f'))
+
+            offset = end
+
+        network = cls(size, tuples, weights)
+
+        if not writable:
+            network.path = path
+
+        return network
+
+    def __reduce__(self):
+        # memory maps cannot be pickled, so worker processes map the file again
+        if self.path is not None:
+            return (NTupleNetwork.load, (self.path,))
+
+        return (NTupleNetwork, (self.size, self.tuples, [array('f', weights) for weights in self.weights]))
+
+def train(board, games, network = None, learning_rate = 0.0025, callback = None):
+    ''' Trains network (a new one if None) by TD(0) on afterstates over games games of self-play, in which
+    it always plays its own best move. callback(game, score) is called after every game. Returns the network.
+    '''
+
+    if network is None:
+        network = NTupleNetwork(board.size)
+
+    if network.size != board.size:
+        raise ValueError('network is for a board of size %d, not %d' % (network.size, board.size))
+
+    for game in range(games):
+        position = board.initial_position()
+        afterstate = None
+
+        while True:
+            move = network.best_move(position)
+
+            if move is None:
+                # the last afterstate led to game over, nothing more to gain from it
+                if afterstate is not None:
+                    network.update(afterstate, -learning_rate * network.value(afterstate))
+                break
+
+            succ = position.successors()[move]
+
+            if afterstate is not None:
+                target = succ.score() - position.score() + network.value(succ)
+                network.update(afterstate, learning_rate * (target - network.value(afterstate)))
+
+            afterstate = succ
+            position = position.result(move)
+
+        if callback is not None:
+            callback(game, position.score())
+
+    return network
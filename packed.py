@@ -0,0 +1,276 @@
+from game import Board, Direction
+from tables import load_tables
+
+# Packed representation of a board of any size: a tuple of one integer per row, in which each cell holds
+# log2 of its tile (0 for empty) in board.cell_bits bits, column 0 lowest. Rows stay small enough to be
+# machine words on the sizes worth playing, and joined in order they give the layout Position.key() packs
+# tiles in.
+#
+# Slides look each row (or gathered column) up in a table of slid rows. Rows short enough to enumerate are
+# precomputed into the table cache, longer ones are slid once and memoized as they are first met.
+
+# rows of at most this many bits get precomputed tables, 65536 entries per direction
+PRECOMPUTE_BITS = 16
+
+# memoized tables are emptied once they hold this many rows, bounding their memory on very large boards
+MEMO_LIMIT = 1 << 20
+
+def _slide_row(row, size, bits, reverse):
+    ''' Slides a row towards column 0 (towards column size - 1 if reverse)
+
+    Returns the new row with the score gained in the bits above it. The largest exponent a cell can hold is
+    never merged, as the result would not fit.
+    '''
+
+    mask = (1 << bits) - 1
+
+    # cells are read, and written back, in the order of the slide
+    shifts = range(bits * (size - 1), -1, -bits) if reverse else range(0, bits * size, bits)
+    out = iter(shifts)
+
+    result = 0
+    score = 0
+
+    # the last tile read, still free to merge with the next one
+    pending = 0
+    for shift in shifts:
+        val = (row >> shift) & mask
+
+        if val != 0:
+            if val == pending and val != mask:
+                score += 1 << (val + 1)
+                result |= (val + 1) << next(out)
+                pending = 0
+            else:
+                if pending:
+                    result |= pending << next(out)
+                pending = val
+
+    if pending:
+        result |= pending << next(out)
+
+    return result | (score << (bits * size))
+
+class _LazyRows(dict):
+    ''' Row table filled in as rows are first looked up '''
+
+    def __init__(self, size, bits, reverse):
+        self.size = size
+        self.bits = bits
+        self.reverse = reverse
+
+    def __missing__(self, row):
+        if len(self) >= MEMO_LIMIT:
+            self.clear()
+
+        result = self[row] = _slide_row(row, self.size, self.bits, self.reverse)
+        return result
+
+class _Spread(dict):
+    ''' Each row with cell j moved to the start of the j-th row's worth of bits, memoized as rows are met '''
+
+    def __init__(self, size, bits):
+        self.size = size
+        self.bits = bits
+
+    def __missing__(self, row):
+        bits = self.bits
+        mask = (1 << bits) - 1
+        result = 0
+
+        for j in range(self.size):
+            result |= ((row >> (bits * j)) & mask) << (bits * self.size * j)
+
+        if len(self) >= MEMO_LIMIT:
+            self.clear()
+
+        self[row] = result
+        return result
+
+class RowTables:
+    ''' Slid rows of a size by size board with bits bits per cell, towards column 0 (left) and away from it (right) '''
+
+    def __init__(self, size, bits):
+        self.size = size
+        self.bits = bits
+        self.rowBits = bits * size
+        self.rowMask = (1 << self.rowBits) - 1
+        self.cellMask = (1 << bits) - 1
+
+        # precomputed entries are stored in 64 bits, which scores of exponents above 31 would overflow
+        self.precomputed = self.rowBits <= PRECOMPUTE_BITS and bits <= 5
+
+        if self.precomputed:
+            self.left, self.right = load_tables('packed-b%d' % bits, size, None, self._build, ('Q', 'Q'))
+        else:
+            self.left = _LazyRows(size, bits, False)
+            self.right = _LazyRows(size, bits, True)
+
+        self.spread = _Spread(size, bits)
+
+    def _build(self):
+        rows = range(1 << self.rowBits)
+
+        return ([_slide_row(row, self.size, self.bits, False) for row in rows],
+                [_slide_row(row, self.size, self.bits, True) for row in rows])
+
+    def transpose(self, rows):
+        ''' The rows of the transposed board, that is its columns read from row 0 down '''
+
+        bits = self.bits
+        rowBits = self.rowBits
+        rowMask = self.rowMask
+        spread = self.spread
+
+        # spreading row i puts its cell j at cell i of row j, once shifted over by i cells
+        board = 0
+        for i, row in enumerate(rows):
+            board |= spread[row] << (bits * i)
+
+        return [(board >> (rowBits * j)) & rowMask for j in range(self.size)]
+
+    def slide(self, rows, move):
+        ''' Returns the rows and score gained after sliding in direction move '''
+
+        rowBits = self.rowBits
+        rowMask = self.rowMask
+
+        # columns slide as rows of the transposed board, up towards row 0 as left is towards column 0
+        transposed = move == Direction.UP or move == Direction.DOWN
+        table = self.left if move == Direction.LEFT or move == Direction.UP else self.right
+
+        slid = [table[row] for row in (self.transpose(rows) if transposed else rows)]
+        gained = 0
+        for row in slid:
+            gained += row >> rowBits
+
+        slid = [row & rowMask for row in slid]
+
+        return tuple(self.transpose(slid) if transposed else slid), gained
+
+# one set of tables per size and cell width, shared by every board in the process
+_tables = {}
+
+def row_tables(size, bits):
+    tables = _tables.get((size, bits))
+
+    if tables is None:
+        tables = _tables[(size, bits)] = RowTables(size, bits)
+
+    return tables
+
+class PackedPosition(Board.Position):
+    ''' Position for boards of any size packed into one integer per row, moves use per size row tables '''
+
+    __slots__ = ('_rows',)
+
+    def __init__(self, board, rows, score = 0, turn = 0):
+        if board is None:
+            raise ValueError('board cannot be None')
+
+        if len(rows) != board.size:
+            raise ValueError('mismatch between number of rows and size of board: %d vs %d' % (len(rows), board.size))
+
+        self._board = board
+        self._rows = rows
+        self._score = score
+        self._turn = turn
+        self._player = 0
+        self._slides = None
+        self._hash = None
+
+    @classmethod
+    def _unpack(cls, board, packed, score, turn):
+        rowBits = board.cell_bits * board.size
+        rows = []
+
+        for _ in range(board.size):
+            rows.append(packed & ((1 << rowBits) - 1))
+            packed >>= rowBits
+
+        return cls(board, tuple(rows), score, turn)
+
+    def _pack(self):
+        rowBits = self._board.cell_bits * self._board.size
+        packed = 0
+
+        for row in reversed(self._rows):
+            packed = (packed << rowBits) | row
+
+        return packed
+
+    def tiles(self):
+        bits = self._board.cell_bits
+        mask = (1 << bits) - 1
+        tiles = []
+
+        for row in self._rows:
+            line = []
+            for _ in range(self._board.size):
+                e = row & mask
+                line.append(1 << e if e else 0)
+                row >>= bits
+            tiles.append(line)
+
+        return tiles
+
+    def duplicate(self):
+        return PackedPosition(self._board, self._rows, score = self._score, turn = self._turn)
+
+    def free_spaces(self):
+        bits = self._board.cell_bits
+        mask = (1 << bits) - 1
+        spaces = []
+
+        for i, row in enumerate(self._rows):
+            for j in range(self._board.size):
+                if row & mask == 0:
+                    spaces.append((i, j))
+                row >>= bits
+
+        return spaces
+
+    def addTile(self, i, j, val):
+        bits = self._board.cell_bits
+        e = val.bit_length() - 1 if val else 0
+
+        if e >> bits:
+            raise ValueError('tile %d does not fit in %d bits per cell' % (val, bits))
+
+        rows = list(self._rows)
+        rows[i] = (rows[i] & ~(((1 << bits) - 1) << (bits * j))) | (e << (bits * j))
+
+        return PackedPosition(self._board, tuple(rows), score = self._score, turn = self._turn)
+
+    def slide(self, move):
+        rows, gained = row_tables(self._board.size, self._board.cell_bits).slide(self._rows, move)
+
+        if rows == self._rows:
+            return None
+
+        succ = PackedPosition(self._board, rows, score = self._score + gained, turn = self._turn)
+        succ._player = 1
+
+        return succ
+
+    def high_tile(self):
+        bits = self._board.cell_bits
+        mask = (1 << bits) - 1
+        largest = 0
+
+        for row in self._rows:
+            while row:
+                if row & mask > largest:
+                    largest = row & mask
+                row >>= bits
+
+        return 1 << largest if largest else 0
+
+    def _tile_hash(self):
+        return hash(self._rows)
+
+    # overriding __eq__ would otherwise clear the inherited __hash__
+    __hash__ = Board.Position.__hash__
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self._rows == other._rows and self._turn == other._turn and self._board is other._board and self._score == other._score and self._player == other._player
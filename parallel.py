@@ -0,0 +1,78 @@
+import functools
+import importlib
+import multiprocessing
+import random
+
+# Policies are closures and cannot be pickled, so every agent factory records how
+# it was called and worker processes rebuild their own copy of each policy.
+
+def agent_factory(factory):
+    ''' Tags the policies built by factory with the call that built them '''
+
+    @functools.wraps(factory)
+    def build(*args, **kwargs):
+        policy = factory(*args, **kwargs)
+        policy.spec = (factory.__module__, factory.__name__, args, kwargs)
+
+        return policy
+
+    return build
+
+def rebuild_agent(spec):
+    module, name, args, kwargs = spec
+
+    return getattr(importlib.import_module(module), name)(*args, **kwargs)
+
+def agent_spec(policy):
+    if not hasattr(policy, "spec"):
+        raise ValueError('policy was not built by an agent factory and cannot be sent to worker processes')
+
+    return policy.spec
+
+def game_seed(seed, game):
+    return seed * 1000003 + game
+
+def seed_game(seed, objects):
+    ''' Seeds the random module from seed, then every random.Random held as the rng attribute of one of
+    objects (policies, boards) from the random module, so that each game gets its own independent streams
+    '''
+
+    random.seed(seed)
+
+    for obj in objects:
+        rng = getattr(obj, "rng", None)
+
+        if isinstance(rng, random.Random):
+            rng.seed(random.getrandbits(64))
+
+_policies = None
+
+def _init_worker(specs):
+    global _policies
+    _policies = [rebuild_agent(spec) for spec in specs]
+
+def _run_game(job):
+    task, seed, args = job
+
+    seed_game(seed, _policies + list(args))
+
+    return task(_policies, *args)
+
+def imap_games(task, policies, games, workers, seed = None, args = (), start = 0):
+    ''' Runs task(policies, *args) once per game across a pool of worker processes
+
+    Each game gets its own seed derived from seed (see seed_game), so results do not depend on how games are
+    scheduled. Games are numbered from start, so a run resumed after start games plays the games it has not.
+    Results are yielded as soon as each game finishes, in completion order.
+    '''
+
+    specs = [agent_spec(policy) for policy in policies]
+
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    jobs = ((task, game_seed(seed, i), args) for i in range(start, start + games))
+
+    with multiprocessing.Pool(workers, initializer = _init_worker, initargs = (specs,)) as pool:
+        for result in pool.imap_unordered(_run_game, jobs):
+            yield result
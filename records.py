@@ -0,0 +1,138 @@
+import json
+import os
+from game import Direction
+
+# Game records are written one JSON object per line, as each game finishes:
+#
+#   game        index of the game in the run
+#   seed        seed of the random module the game was played from
+#   size, fp    the board played on
+#   start       the two initial tiles, as [i, j, value]
+#   moves       one letter (U, D, L, R) per move
+#   spawns      the tile placed after each move, as [i, j, value]
+#   times       milliseconds the policy took to choose each move
+#   score, turns, high_tile
+#   iterations  iterations reported by a time-budgeted policy for each move, if any
+#
+# start, moves and spawns are enough for replay() to rebuild every position of the game.
+
+LETTERS = { Direction.UP: 'U', Direction.DOWN: 'D', Direction.LEFT: 'L', Direction.RIGHT: 'R' }
+MOVES = { letter: move for move, letter in LETTERS.items() }
+
+def spawned_tile(before, after):
+    ''' The (i, j, value) tile placed on before to make after '''
+
+    packed = after._pack()
+    bits = after._board.cell_bits
+
+    # only the spawned cell differs between the two packings
+    k = ((packed ^ before._pack()).bit_length() - 1) // bits
+    size = after._board.size
+
+    return [k // size, k % size, 1 << ((packed >> (bits * k)) & ((1 << bits) - 1))]
+
+class GameTrace:
+    ''' Collects the moves, spawns and decision times of a game as play_game plays it '''
+
+    def __init__(self):
+        self.start = None
+        self.moves = []
+        self.spawns = []
+        self.times = []
+
+    def begin(self, position):
+        tiles = position.tiles()
+        self.start = [[i, j, val] for i, row in enumerate(tiles) for j, val in enumerate(row) if val]
+
+    def add(self, position, move, seconds, succ):
+        self.moves.append(LETTERS[move])
+        self.spawns.append(spawned_tile(position.successors()[move], succ))
+        self.times.append(round(seconds * 1000, 3))
+
+    def record(self, game, seed, final, iterations = None):
+        record = {
+            "game": game,
+            "seed": seed,
+            "size": final._board.size,
+            "fp": final._board.fp,
+            "start": self.start,
+            "moves": "".join(self.moves),
+            "spawns": self.spawns,
+            "times": self.times,
+            "score": final.score(),
+            "turns": final.turn(),
+            "high_tile": final.high_tile()
+        }
+
+        if iterations:
+            record["iterations"] = list(iterations)
+
+        return record
+
+class RecordWriter:
+    ''' Appends game records to path, flushing each one as soon as it is written
+
+    With resume set, the records already in path are kept (and loaded into records) and only a final line
+    cut short by a crash is dropped; otherwise path is started afresh.
+    '''
+
+    def __init__(self, path, resume = False):
+        self.path = path
+        self.records = []
+
+        if resume and os.path.exists(path):
+            self.records, valid = read_records(path)
+            os.truncate(path, valid)
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators = (',', ':')) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_records(path):
+    ''' Returns the complete records in path and the length in bytes of the file they span '''
+
+    records = []
+    valid = 0
+
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+
+            valid += len(line)
+
+    return records, valid
+
+def replay(board, record):
+    ''' Yields every position of the recorded game in order, from the initial position to the final one '''
+
+    position = board.empty_position()
+    for i, j, val in record["start"]:
+        position = position.addTile(i, j, val)
+
+    yield position
+
+    for letter, (i, j, val) in zip(record["moves"], record["spawns"]):
+        succ = position.successors().get(MOVES[letter])
+
+        if succ is None:
+            raise ValueError('illegal move %s on turn %d of game %d' % (letter, position.turn(), record["game"]))
+
+        position = succ.addTile(i, j, val)
+        position._turn += 1
+
+        yield position
+
+    if position.score() != record["score"] or position.turn() != record["turns"]:
+        raise ValueError('replay of game %d does not reach its recorded score and turn count' % record["game"])
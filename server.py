@@ -0,0 +1,371 @@
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from agents import take_iterations
+from game import Board
+from parallel import agent_spec, rebuild_agent
+from records import LETTERS, MOVES
+
+# Agent server: plays any number of games at once for its clients, over stdin/stdout or a socket, one JSON
+# object per line each way. Every request may carry an id, which its reply echoes, as replies are sent as
+# soon as they are ready rather than in the order requests came in.
+#
+#   {"op": "new", "size": 4, "backend": "list", "seed": 1}   start a game (all fields optional)
+#   {"op": "move", "game": 0, "move": "L"}                   play a move (U, D, L or R) in a game
+#   {"op": "agent", "game": 0, "play": true, "deadline_ms": 500}
+#                                                            ask the agent for a move, playing it unless play
+#                                                            is false, failing if no move comes in time
+#   {"op": "state", "game": 0}                               the game as it stands
+#   {"op": "close", "game": 0}                               forget a game
+#   {"op": "stats"}                                          counters of the server
+#
+# Replies carry the game's state (game, tiles, score, turn, high_tile, over), the move chosen for agent
+# requests, or an error. Agent decisions run in a pool of worker processes: requests arriving together are
+# gathered into a batch and handed to the pool most urgent first, one job per request, so each is answered as
+# soon as its own decision is made. Requests whose deadline has passed are dropped, by the server while they
+# are queued or by the worker that picks them up.
+
+# decision requests arriving within this many seconds of the first are batched with it
+BATCH_WINDOW = 0.002
+
+# most decision requests in one batch
+BATCH_LIMIT = 64
+
+### worker processes
+
+_policy = None
+_boards = {}
+
+def _init_worker(spec):
+    global _policy
+    _policy = rebuild_agent(spec)
+
+# what _decide returns for a job picked up after its deadline
+EXPIRED = ''
+
+def _decide(job):
+    ''' Worker entry point: the letter of the move the policy picks for a (deadline, size, fp, backend, key)
+    job, or EXPIRED without deciding if time.monotonic() has passed its deadline
+    '''
+
+    deadline, size, fp, backend, key = job
+
+    if deadline is not None and time.monotonic() >= deadline:
+        return EXPIRED
+
+    board = _boards.get((size, fp, backend))
+
+    if board is None:
+        board = _boards[(size, fp, backend)] = Board(size, fp, backend)
+
+    move = _policy(board.from_key(key))
+
+    # workers serve for good, so what time-budgeted policies report is dropped after every decision
+    take_iterations(_policy)
+
+    return LETTERS[move] if move is not None else None
+
+### games
+
+class Game:
+    def __init__(self, number, position):
+        self.number = number
+        self.position = position
+        self.moves = []
+
+        # an agent request holds the game until its move is played, so moves never interleave
+        self.lock = asyncio.Lock()
+
+    def play(self, letter):
+        if letter not in MOVES:
+            raise ValueError('move must be one of U, D, L, R: %s' % letter)
+
+        succ = self.position.result(MOVES[letter])
+
+        if succ is None:
+            raise ValueError('illegal move %s' % letter)
+
+        self.position = succ
+        self.moves.append(letter)
+
+    def state(self):
+        position = self.position
+
+        return { "game": self.number, "tiles": position.tiles(), "score": position.score(), "turn": position.turn(),
+                 "high_tile": position.high_tile(), "over": position.game_over() }
+
+class _StdoutWriter:
+    ''' The part of asyncio.StreamWriter serve_stream uses, writing to stdout '''
+
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def drain(self):
+        pass
+
+class _StdinReader:
+    ''' The part of asyncio.StreamReader serve_stream uses, reading stdin in a thread, for stdin that is a
+    regular file rather than a pipe or a terminal
+    '''
+
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(None, sys.stdin.buffer.readline)
+
+class AgentServer:
+    ''' Serves games against policy (built by an agent factory) to many clients at once
+
+    Games are played on size by size boards of backend unless a client asks otherwise. policy is rebuilt
+    in each of workers processes. Agent requests fail after deadline_ms milliseconds unless they give a
+    deadline of their own (None waits as long as it takes).
+    '''
+
+    def __init__(self, policy, size = 4, backend = 'list', workers = 1, deadline_ms = None):
+        self.spec = agent_spec(policy)
+        self.size = size
+        self.backend = backend
+        self.workers = workers
+        self.deadline_ms = deadline_ms
+
+        self.games = {}
+        self.nextGame = 0
+
+        self.decisions = 0
+        self.batches = 0
+        self.expired = 0
+
+        self.executor = None
+        self.queue = None
+        self.dispatcher = None
+        self.running = set()
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(self.workers, initializer = _init_worker, initargs = (self.spec,))
+        self.queue = asyncio.Queue()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    def close(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+
+    async def decide(self, game, deadline_ms):
+        ''' The letter of the agent's move in game, raises asyncio.TimeoutError once deadline_ms have passed '''
+
+        loop = asyncio.get_running_loop()
+        position = game.position
+        board = position._board
+
+        # on time.monotonic(), which worker processes share, rather than the event loop's clock
+        deadline = None if deadline_ms is None else time.monotonic() + deadline_ms / 1000
+        future = loop.create_future()
+
+        await self.queue.put((deadline, (deadline, board.size, board.fp, board.backend, position.key()), future))
+
+        # a request timed out while queued is cancelled here, and skipped by the dispatcher
+        return await asyncio.wait_for(future, None if deadline is None else deadline - time.monotonic())
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            end = loop.time() + BATCH_WINDOW
+
+            while len(batch) < BATCH_LIMIT and loop.time() < end:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), end - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+
+            live = [request for request in batch if not request[2].done()]
+            self.expired += len(batch) - len(live)
+
+            if not live:
+                continue
+
+            # most urgent first: the pool hands jobs to its workers in the order they are submitted
+            live.sort(key = lambda request: math.inf if request[0] is None else request[0])
+            self.batches += 1
+
+            for request in live:
+                task = asyncio.create_task(self._run(request))
+
+                # the event loop only keeps weak references to tasks
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+    async def _run(self, request):
+        _, job, future = request
+
+        try:
+            letter = await asyncio.get_running_loop().run_in_executor(self.executor, _decide, job)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(ValueError('agent failed: %r' % e))
+            return
+
+        if letter == EXPIRED:
+            self.expired += 1
+            return
+
+        self.decisions += 1
+
+        if not future.done():
+            future.set_result(letter)
+
+    def game(self, request):
+        game = self.games.get(request.get("game"))
+
+        if game is None:
+            raise ValueError('unknown game: %s' % request.get("game"))
+
+        return game
+
+    async def handle(self, request):
+        ''' Returns the reply to request, raises ValueError for a request that cannot be served '''
+
+        op = request.get("op")
+
+        if op == "new":
+            size = request.get("size", self.size)
+            backend = request.get("backend", self.backend)
+            seed = request.get("seed")
+
+            # two tiles are placed to start a game
+            if not isinstance(size, int) or size < 2:
+                raise ValueError('size must be an integer of at least 2: %s' % size)
+
+            board = Board(size, backend = backend, rng = None if seed is None else random.Random(seed))
+
+            game = self.games[self.nextGame] = Game(self.nextGame, board.initial_position())
+            self.nextGame += 1
+
+            return game.state()
+        elif op == "move":
+            game = self.game(request)
+
+            async with game.lock:
+                game.play(request.get("move"))
+                return game.state()
+        elif op == "agent":
+            game = self.game(request)
+            deadline_ms = request.get("deadline_ms", self.deadline_ms)
+
+            async with game.lock:
+                if game.position.game_over():
+                    raise ValueError('game %d is over' % game.number)
+
+                try:
+                    letter = await self.decide(game, deadline_ms)
+                except asyncio.TimeoutError:
+                    raise ValueError('no move within the deadline of %s ms' % deadline_ms)
+
+                if request.get("play", True):
+                    game.play(letter)
+
+                reply = game.state()
+                reply["move"] = letter
+
+                return reply
+        elif op == "state":
+            return self.game(request).state()
+        elif op == "close":
+            game = self.game(request)
+            del self.games[game.number]
+
+            return { "game": game.number, "closed": True }
+        elif op == "stats":
+            return { "games": len(self.games), "decisions": self.decisions, "batches": self.batches,
+                     "expired": self.expired, "workers": self.workers }
+
+        raise ValueError('unknown op: %s' % op)
+
+    async def _respond(self, line, writer, lock):
+        request = None
+
+        try:
+            request = json.loads(line)
+
+            if not isinstance(request, dict):
+                raise ValueError('requests must be JSON objects')
+
+            reply = await self.handle(request)
+        except (ValueError, TypeError) as e:
+            reply = { "error": str(e) }
+        except Exception as e:
+            # a client gets a reply to every request, whatever goes wrong serving it
+            reply = { "error": repr(e) }
+
+        if isinstance(request, dict) and "id" in request:
+            reply["id"] = request["id"]
+
+        async with lock:
+            writer.write((json.dumps(reply, separators = (',', ':')) + "\n").encode())
+            await writer.drain()
+
+    async def serve_stream(self, reader, writer):
+        ''' Serves the requests read from reader, each in a task of its own, until reader is exhausted '''
+
+        lock = asyncio.Lock()
+        tasks = set()
+
+        while True:
+            line = await reader.readline()
+
+            if not line:
+                break
+
+            if not line.strip():
+                continue
+
+            task = asyncio.create_task(self._respond(line, writer, lock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def serve_connection(self, reader, writer):
+        try:
+            await self.serve_stream(reader, writer)
+        finally:
+            writer.close()
+
+async def _serve(server, path, port):
+    await server.start()
+
+    try:
+        if path is not None:
+            listener = await asyncio.start_unix_server(server.serve_connection, path)
+        elif port is not None:
+            listener = await asyncio.start_server(server.serve_connection, '127.0.0.1', port)
+        else:
+            reader = asyncio.StreamReader()
+
+            try:
+                await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            except ValueError:
+                # pipe transports only take pipes, sockets and character devices
+                reader = _StdinReader()
+
+            await server.serve_stream(reader, _StdoutWriter())
+            return
+
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+def serve(policy, size = 4, backend = 'list', workers = 1, deadline_ms = None, path = None, port = None):
+    ''' Runs an AgentServer on the unix socket path, on TCP port port of localhost, or else on stdin and stdout
+    until stdin is closed
+    '''
+
+    asyncio.run(_serve(AgentServer(policy, size, backend, workers, deadline_ms), path, port))
@@ -0,0 +1,117 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+# On-disk cache of precomputed lookup tables. Each set of tables is built once, written to a binary file
+# named after the set, the board size and spawn probability and the cache version, and from then on
+# opened through a read-only memory map, so every process (pool workers included) shares the same pages
+# instead of rebuilding or unpickling its own copy.
+
+MAGIC = b'2048TBLS'
+
+# bump whenever a table builder changes, so stale files are rebuilt rather than trusted
+VERSION = 1
+
+def cache_dir():
+    ''' Directory of cached tables: $TABLE_CACHE if set, otherwise .tables next to this module '''
+
+    return os.environ.get('TABLE_CACHE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tables')
+
+def cache_path(name, size, fp = None):
+    ''' fp is None for tables that do not depend on the spawn probability '''
+
+    return os.path.join(cache_dir(), '%s-v%d-s%d-fp%s.bin' % (name, VERSION, size, 'any' if fp is None else repr(fp)))
+
+def _write(path, tables, typecodes):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    # written under a temporary name and renamed into place, so a process never maps a half written file
+    fd, temp = tempfile.mkstemp(dir = os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<II', VERSION, len(tables)))
+
+            for table, typecode in zip(tables, typecodes):
+                f.write(struct.pack('<cI', typecode.encode(), len(table)))
+
+            for table, typecode in zip(tables, typecodes):
+                data = array(typecode, table)
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                f.write(data.tobytes())
+
+        # mkstemp creates files readable by their owner only
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+def _open(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+
+    offset = len(MAGIC)
+    version, count = struct.unpack_from('<II', data, offset)
+    offset += 8
+
+    if version != VERSION:
+        return None
+
+    layout = []
+    for _ in range(count):
+        typecode, length = struct.unpack_from('<cI', data, offset)
+        layout.append((typecode.decode(), length))
+        offset += struct.calcsize('<cI')
+
+    tables = []
+    for typecode, length in layout:
+        end = offset + length * array(typecode).itemsize
+
+        if end > len(data):
+            return None
+
+        if sys.byteorder == 'little':
+            tables.append(memoryview(data)[offset:end].cast(typecode))
+        else:
+            table = array(typecode, data[offset:end])
+            table.byteswap()
+            tables.append(table)
+
+        offset = end
+
+    return tables
+
+def load_tables(name, size, fp, build, typecodes):
+    ''' Returns the tables build() makes, as read-only sequences of ints memory-mapped from the cache
+
+    typecodes gives the array typecode each table is stored with. build() only runs when no valid cache file
+    exists for this name, size, fp and version. If the cache cannot be written (a read-only checkout), the
+    freshly built tables are returned as they are.
+    '''
+
+    path = cache_path(name, size, fp)
+
+    try:
+        tables = _open(path)
+    except (OSError, ValueError, struct.error):
+        tables = None
+
+    if tables is not None and len(tables) == len(typecodes):
+        return tables
+
+    tables = build()
+
+    try:
+        _write(path, tables, typecodes)
+        return _open(path)
+    except OSError:
+        return tables